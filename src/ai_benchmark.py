@@ -0,0 +1,96 @@
+import argparse
+import statistics
+from multiprocessing import get_context
+from time import perf_counter
+
+from ai_helper import BACKENDS, load_model, toxicity_analysis
+
+# Fixed chat corpus, so runs on different machines/backends can be compared
+CORPUS = [
+    'W', 'LUL', 'KEKW KEKW KEKW', 'PogChamp', 'gg', 'first', 'hello chat!', 'lets goooo',
+    'what song is this?', 'this streamer is so bad lmao', 'I love this community <3',
+    'you are trash uninstall the game', 'can you play some lofi pls', 'when is the next stream?',
+    'that was the best clutch I have ever seen', 'Kappa Kappa Kappa Kappa', 'nobody asked',
+    'thanks for the raid!', 'the audio is too loud, can you turn it down a bit', 'ez',
+    'this is boring, I am leaving', 'OMEGALUL he missed everything', 'go to sleep bro',
+    'hi from italy! ciao a tutti', 'what is your sensitivity and dpi?', 'mods please ban this guy',
+    'absolutely incredible gameplay today, you deserve way more viewers honestly',
+    'worst stream ever, refund my sub', 'LETS GOOOOOOOOOOOOOOO', 'monkaS', 'Clap Clap Clap',
+    'can we get some hype in the chat for the new sub', '!song', 'bro really thought that would work',
+    'I have been watching for 3 years and this is still my favourite channel',
+    'stop backseating guys let him play', 'ratio', 'you will never be good at this game',
+    'how much did your setup cost?', 'sending love from brazil'
+]
+
+
+def get_rss():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        import resource
+        # Peak RSS, reported in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def benchmark_backend(backend_name, batch_size, rounds):
+    rss_before = get_rss()
+    start = perf_counter()
+    load_model(backend_name)
+    load_time = perf_counter() - start
+    toxicity_analysis(CORPUS[:batch_size])
+
+    latencies = []
+    for message in CORPUS:
+        start = perf_counter()
+        toxicity_analysis([message])
+        latencies.append((perf_counter() - start) * 1000)
+
+    messages = CORPUS * rounds
+    start = perf_counter()
+    for idx in range(0, len(messages), batch_size):
+        toxicity_analysis(messages[idx:idx + batch_size])
+    throughput = len(messages) / (perf_counter() - start)
+
+    rss_after = get_rss()
+    return {
+        'backend': backend_name,
+        'load_s': load_time,
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': statistics.quantiles(latencies, n=20)[-1],
+        'msg_per_s': throughput,
+        'rss_mb': (rss_after - rss_before) / 1024 / 1024 if rss_before is not None else None
+    }
+
+
+def run_isolated(backend_name, batch_size, rounds):
+    # Every backend runs in a fresh process, otherwise the RSS of the previous one would be counted
+    with get_context('spawn').Pool(1) as pool:
+        return pool.apply(benchmark_backend, (backend_name, batch_size, rounds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the toxicity backends on a fixed chat corpus')
+    parser.add_argument('backends', nargs='*', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'backend':<10} {'load (s)':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'msg/s':>8} {'RSS (MB)':>9}")
+    for backend_name in args.backends:
+        try:
+            result = run_isolated(backend_name, args.batch_size, args.rounds)
+        except ImportError as e:
+            print(f"{backend_name:<10} not available: {e}")
+            continue
+        rss = f"{result['rss_mb']:.0f}" if result['rss_mb'] is not None else 'n/a'
+        print(f"{result['backend']:<10} {result['load_s']:>9.2f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['msg_per_s']:>8.1f} {rss:>9}")
+
+
+if __name__ == '__main__':
+    main()
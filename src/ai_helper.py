@@ -1,31 +1,367 @@
-from torch import no_grad, FloatTensor, softmax
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+import os
+import random
+import re
+from asyncio import Queue, QueueEmpty, create_task, get_running_loop, sleep, wait_for, CancelledError
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, monotonic
 
-tokenizer = AutoTokenizer.from_pretrained("DT12the/distilbert-sentiment-analysis")
-model = AutoModelForSequenceClassification.from_pretrained("DT12the/distilbert-sentiment-analysis")
+import prefilter
+from cache_utils import LRUCache
+from emote_utils import parse_emote_ranges, strip_emotes
+from reconnect import backoff_delay
+
+MODEL_NAME = "DT12the/distilbert-sentiment-analysis"
+MODELS_FOLDER = 'config/models'
+MAX_LENGTH = 512
+# Weight of the newest sample in the scoring latency moving average
+LATENCY_SMOOTHING = 0.2
+FULL_MODE = 'full'
+SAMPLING_MODE = 'sampling'
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+REPEATED_CHARACTERS_PATTERN = re.compile(r'(.)\1{2,}')
+REPEATED_WORDS_PATTERN = re.compile(r'(?<!\S)(\S+)(?: \1)+(?!\S)')
+
+# torch and transformers are only imported by the backends, so they don't slow down the startup
+backend = None
 
 # THIS SUCKS IN ITALIAN
 
 
-def toxicity_analysis(message):
-    tokenized_message = tokenizer(message, truncation=True, max_length=512, padding='max_length', return_tensors="pt")
-    input_ids = tokenized_message['input_ids']
-    attention_mask = tokenized_message['attention_mask'].type(FloatTensor)
+class TorchBackend:
+    name = 'pytorch'
+
+    def __init__(self):
+        self.tokenizer = None
+        self.model = None
+
+    def load(self):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        self.model = self.load_model()
+        self.model.eval()
+
+    def load_model(self):
+        from transformers import AutoModelForSequenceClassification
+        return AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+
+    def tokenize(self, messages, return_tensors):
+        # Dynamic padding: the batch is only padded up to its longest message
+        return self.tokenizer(messages, truncation=True, max_length=MAX_LENGTH, padding=True,
+                              return_tensors=return_tensors)
+
+    def predict(self, messages):
+        from torch import inference_mode, softmax
+        tokenized_messages = self.tokenize(messages, "pt")
+        with inference_mode():
+            outputs = self.model(input_ids=tokenized_messages['input_ids'],
+                                 attention_mask=tokenized_messages['attention_mask'])
+        return softmax(outputs.logits, dim=1).numpy()
+
+
+class QuantizedTorchBackend(TorchBackend):
+    name = 'quantized'
+    file_name = 'distilbert-sentiment-int8.pt'
+
+    def load_model(self):
+        import torch
+        model_path = os.path.join(MODELS_FOLDER, self.file_name)
+        if os.path.exists(model_path):
+            return torch.load(model_path, weights_only=False)
+        # Dynamic int8 quantization of the Linear layers, done once and cached on disk
+        model = torch.quantization.quantize_dynamic(super().load_model(), {torch.nn.Linear}, dtype=torch.qint8)
+        os.makedirs(MODELS_FOLDER, exist_ok=True)
+        torch.save(model, model_path)
+        return model
+
+
+class OnnxBackend(TorchBackend):
+    name = 'onnx'
+    file_name = 'distilbert-sentiment.onnx'
+
+    def load_model(self):
+        import onnxruntime
+        model_path = os.path.join(MODELS_FOLDER, self.file_name)
+        if not os.path.exists(model_path):
+            self.export(model_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+    def export(self, model_path):
+        import torch
+        model = super().load_model()
+        model.eval()
+        sample = self.tokenize(['Export sample'], "pt")
+        os.makedirs(MODELS_FOLDER, exist_ok=True)
+        torch.onnx.export(model, (sample['input_ids'], sample['attention_mask']), model_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'logits': {0: 'batch'}},
+                          opset_version=14)
+
+    def load(self):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        self.model = self.load_model()
+
+    def predict(self, messages):
+        import numpy
+        tokenized_messages = self.tokenize(messages, "np")
+        logits = self.model.run(['logits'], {'input_ids': tokenized_messages['input_ids'].astype(numpy.int64),
+                                             'attention_mask': tokenized_messages['attention_mask'].astype(numpy.int64)})[0]
+        exponentials = numpy.exp(logits - logits.max(axis=1, keepdims=True))
+        return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    QuantizedTorchBackend.name: QuantizedTorchBackend,
+    OnnxBackend.name: OnnxBackend
+}
+
+
+def load_model(backend_name=TorchBackend.name):
+    global backend
+    new_backend = BACKENDS[backend_name]()
+    new_backend.load()
+    backend = new_backend
+    return backend
+
 
-    with no_grad():
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-    probabilities = softmax(outputs.logits, dim=1)
-    probabilities = probabilities.numpy()
+def toxicity_analysis(messages):
+    probabilities = backend.predict(messages)
+    return [format_analysis(row[0] * 100, row[1] * 100) for row in probabilities]
 
-    positive_percentage = probabilities[0, 0] * 100
-    negative_percentage = probabilities[0, 1] * 100
 
+def normalize_text(text):
+    # "LULLLL  lul LUL" and "LULL lul" end up with the same cache key, "lull lul"
+    text = WHITESPACE_PATTERN.sub(' ', text.casefold()).strip()
+    text = REPEATED_CHARACTERS_PATTERN.sub(r'\1\1', text)
+    return REPEATED_WORDS_PATTERN.sub(r'\1', text)
+
+
+def format_analysis(positive_percentage, negative_percentage):
     return ("🟢 " + str("{:.2f}%".format(positive_percentage))) if positive_percentage > negative_percentage else (
             "🔴 " + str("{:.2f}%".format(negative_percentage)))
 
 
-async def analyse_and_print(self, message):
-    analysis = toxicity_analysis(message['parameters'].strip('\r\n'))
-    self.manager.print.print_to_logs(
-        f"{message['tags']['display-name']}, {message['parameters'].strip('\r\n')} | {analysis}",
-        self.manager.print.BLUE)
\ No newline at end of file
+class ToxicityAnalyser:
+    def __init__(self, manager):
+        self.manager = manager
+        self.queue = Queue()
+        self.worker = None
+        self.warm_up_task = None
+        self.ready = False
+        self.cache = LRUCache(int(self.manager.configuration['ai']['cache_size']))
+        self.mode = FULL_MODE
+        self.latency = 0.0
+        self.shed = 0
+        self.scored = 0
+        # Overrides ai/backend, set when the model lives in the shared inference process
+        self.backend_name = None
+        # A single thread keeps the model off the event loop without fighting over the CPU
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='toxicity')
+
+    @property
+    def max_batch_size(self):
+        return max(int(self.manager.configuration['ai']['max_batch_size']), 1)
+
+    @property
+    def max_latency(self):
+        return max(int(self.manager.configuration['ai']['max_latency_ms']), 0) / 1000
+
+    @property
+    def shed_queue_depth(self):
+        return max(int(self.manager.configuration['ai']['shed_queue_depth']), 1)
+
+    @property
+    def shed_latency(self):
+        return max(int(self.manager.configuration['ai']['shed_latency_ms']), 1) / 1000
+
+    @property
+    def sample_rate(self):
+        return float(self.manager.configuration['ai']['sample_rate'])
+
+    def update_mode(self):
+        depth = self.queue.qsize()
+        if self.mode == FULL_MODE and (depth > self.shed_queue_depth or self.latency > self.shed_latency):
+            self.mode = SAMPLING_MODE
+            self.manager.print.print_to_logs(f"Chat analysis switched to sampling (queue {depth}, "
+                                             f"latency {self.latency * 1000:.0f}ms)", self.manager.print.YELLOW)
+        # Hysteresis: only go back once the load is well below the thresholds
+        elif self.mode == SAMPLING_MODE and depth <= self.shed_queue_depth // 2 and self.latency <= self.shed_latency / 2:
+            self.mode = FULL_MODE
+            self.manager.print.print_to_logs(f"Chat analysis back to full scoring ({self.shed} shed so far)",
+                                             self.manager.print.GREEN)
+
+    def should_shed(self, priority):
+        self.update_mode()
+        if self.queue.qsize() >= self.shed_queue_depth * 4:
+            # Hard cap, the backlog never grows without bound
+            return True
+        if self.mode == FULL_MODE or priority:
+            return False
+        return random.random() >= self.sample_rate
+
+    def start(self):
+        if self.worker is None:
+            self.worker = create_task(self.run())
+
+    def warm_up_in_background(self):
+        if self.warm_up_task is None:
+            self.warm_up_task = create_task(self.warm_up())
+
+    async def warm_up(self):
+        self.manager.print.print_to_logs('Loading toxicity model in the background...', self.manager.print.BRIGHT_PURPLE)
+        start = perf_counter()
+        backend_name = self.backend_name or self.manager.configuration['ai']['backend']
+        if backend_name not in BACKENDS:
+            self.manager.print.print_to_logs(f"Unknown toxicity backend {backend_name}, falling back to pytorch",
+                                             self.manager.print.YELLOW)
+            backend_name = TorchBackend.name
+        if self.backend_name is not None:
+            await self.load_shared(backend_name)
+        else:
+            backend_name = await self.load_local(backend_name)
+            if backend_name is None:
+                return
+        self.ready = True
+        self.manager.print.print_to_logs(
+            f"Toxicity model ({backend_name}) loaded in {perf_counter() - start:.2f}s "
+            f"({perf_counter() - self.manager.startup_time:.2f}s after startup)", self.manager.print.GREEN)
+
+    async def load_shared(self, backend_name):
+        # Set by the supervisor: the shared process is waited for, a model loaded here would defeat it
+        loop = get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, load_model, backend_name)
+                return
+            except (ImportError, RuntimeError, OSError, EOFError) as e:
+                delay = backoff_delay(attempt)
+                attempt += 1
+                self.manager.print.print_to_logs(f"Toxicity backend {backend_name} not ready ({e!r}), "
+                                                 f"retrying in {delay:.1f}s", self.manager.print.YELLOW)
+                await sleep(delay)
+
+    async def load_local(self, backend_name):
+        loop = get_running_loop()
+        # Optional backends (onnxruntime) may be missing, pytorch is always tried last
+        for candidate in dict.fromkeys((backend_name, TorchBackend.name)):
+            try:
+                await loop.run_in_executor(self.executor, load_model, candidate)
+                return candidate
+            except ImportError as e:
+                self.manager.print.print_to_logs(f"Toxicity backend {candidate} not available: {e}",
+                                                 self.manager.print.YELLOW)
+            except Exception as e:
+                self.manager.print.print_to_logs(f"Toxicity model failed to load: {e}", self.manager.print.RED)
+                return None
+        return None
+
+    async def stop(self):
+        for task in (self.warm_up_task, self.worker):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except CancelledError:
+                    pass
+        self.warm_up_task = None
+        self.worker = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, author, text, cleaned_text=None, priority=False):
+        # cleaned_text is what the model sees, text is what ends up in the logs
+        cleaned_text = text if cleaned_text is None else cleaned_text
+        if not self.ready or not cleaned_text:
+            # Chat is still logged while the model warms up, just without a score
+            self.manager.print.print_to_logs(f"{author}, {text}", self.manager.print.BLUE)
+            return
+        key = normalize_text(cleaned_text)
+        analysis = self.cache.get(key)
+        if analysis is not None:
+            self.manager.print.print_to_logs(f"{author}, {text} | {analysis}", self.manager.print.BLUE)
+            return
+        if self.should_shed(priority):
+            self.shed += 1
+            self.manager.print.print_to_logs(f"{author}, {text}", self.manager.print.BLUE)
+            return
+        self.queue.put_nowait((author, text, cleaned_text, key, monotonic()))
+
+    async def collect_batch(self):
+        loop = get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await wait_for(self.queue.get(), timeout))
+            except TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = get_running_loop()
+        while True:
+            batch = await self.collect_batch()
+            # Everything queued already missed the cache in submit(), copypasta inside the batch is scored once
+            pending = {}
+            results = {}
+            for _, _, cleaned_text, key, _ in batch:
+                pending.setdefault(key, cleaned_text)
+            analyses = []
+            try:
+                if pending:
+                    analyses = await loop.run_in_executor(self.executor, toxicity_analysis, list(pending.values()))
+            except CancelledError:
+                raise
+            except Exception as e:
+                self.manager.print.print_to_logs(f"Toxicity analysis failed: {e}", self.manager.print.RED)
+                continue
+            for key, analysis in zip(pending, analyses):
+                results[key] = analysis
+                self.cache.put(key, analysis)
+            self.manager.print.print_batch_to_logs(
+                [f"{author}, {text} | {results[key]}" for author, text, _, key, _ in batch], self.manager.print.BLUE)
+            # The oldest message of the batch is the one that waited the most
+            batch_latency = monotonic() - min(queued_at for *_, queued_at in batch)
+            self.latency += (batch_latency - self.latency) * LATENCY_SMOOTHING
+            self.scored += len(batch)
+            self.update_mode()
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'mode': self.mode,
+            'queue_depth': self.queue.qsize(),
+            'latency_ms': round(self.latency * 1000),
+            'scored': self.scored,
+            'shed': self.shed,
+            'cache': self.cache.stats()
+        }
+
+
+def analyse_and_print(self, message):
+    verdict, _ = self.manager.prefilter.classify(message)
+    match verdict:
+        case prefilter.SKIP:
+            self.manager.print.print_to_logs(f"{message.display_name}, {message.parameters}",
+                                             self.manager.print.BLUE)
+        case _:
+            # Emote codes are dropped or collapsed before tokenization, chat display is untouched
+            cleaned_text = strip_emotes(message.parameters, parse_emote_ranges(message.tags.get('emotes')),
+                                        self.manager.configuration['ai']['emote_mode'])
+            # First-time chatters are always scored, even while shedding load
+            self.manager.analyser.submit(message.display_name, message.parameters, cleaned_text,
+                                         priority=bool(message.tags.get('first-msg')))
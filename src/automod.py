@@ -0,0 +1,154 @@
+import os
+from collections import deque
+from time import monotonic
+
+BANNED_TERMS_FILE = 'config/banned_terms.txt'
+# How often the terms file is checked for changes, in seconds
+REFRESH_INTERVAL = 5
+
+# Same length substitutions only, so match positions stay valid on the normalized text
+LEET_TABLE = str.maketrans({
+    '4': 'a', '@': 'a',
+    '8': 'b',
+    '3': 'e',
+    '6': 'g', '9': 'g',
+    '1': 'i',
+    '0': 'o',
+    '5': 's', '$': 's',
+    '7': 't'
+})
+
+
+def normalize_text(text):
+    return text.lower().translate(LEET_TABLE)
+
+
+def load_banned_terms(file_name=BANNED_TERMS_FILE):
+    terms = set()
+    if os.path.exists(file_name):
+        with open(file_name, 'r', encoding='utf-8') as f:
+            for line in f:
+                term = ' '.join(normalize_text(line.split('#')[0]).split())
+                if term:
+                    terms.add(term)
+    return terms
+
+
+class AhoCorasick:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.terms_at = [None]
+        self.outputs = [()]
+        self.terms = set()
+
+    def add(self, term):
+        node = 0
+        for char in term:
+            next_node = self.transitions[node].get(char)
+            if next_node is None:
+                next_node = len(self.transitions)
+                self.transitions[node][char] = next_node
+                self.transitions.append({})
+                self.fail.append(0)
+                self.terms_at.append(None)
+                self.outputs.append(())
+            node = next_node
+        self.terms_at[node] = term
+        self.terms.add(term)
+
+    def link(self):
+        # Breadth first, so the failure target of a node is always linked before the node itself
+        queue = deque()
+        for node in self.transitions[0].values():
+            self.fail[node] = 0
+            self.outputs[node] = (self.terms_at[node],) if self.terms_at[node] else ()
+            queue.append(node)
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.transitions[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                fail = self.transitions[fail].get(char, 0)
+                self.fail[next_node] = fail
+                own = (self.terms_at[next_node],) if self.terms_at[next_node] else ()
+                self.outputs[next_node] = own + self.outputs[fail]
+                queue.append(next_node)
+
+    def update(self, terms):
+        # Added terms extend the trie in place, removed ones would leave dead nodes behind so it is built again
+        if self.terms - terms:
+            self.reset()
+        for term in terms - self.terms:
+            self.add(term)
+        self.link()
+
+    def search(self, text):
+        node = 0
+        transitions = self.transitions
+        for idx, char in enumerate(text):
+            while node and char not in transitions[node]:
+                node = self.fail[node]
+            node = transitions[node].get(char, 0)
+            for term in self.outputs[node]:
+                yield idx - len(term) + 1, term
+
+
+class BannedTermMatcher:
+    def __init__(self, manager, file_name=BANNED_TERMS_FILE):
+        self.manager = manager
+        self.file_name = file_name
+        self.automaton = AhoCorasick()
+        self.last_modified = None
+        self.next_refresh = 0
+        self.matches = 0
+        self.refresh()
+
+    def refresh(self):
+        self.next_refresh = monotonic() + REFRESH_INTERVAL
+        last_modified = os.path.getmtime(self.file_name) if os.path.exists(self.file_name) else None
+        if last_modified == self.last_modified:
+            return
+        self.last_modified = last_modified
+        terms = load_banned_terms(self.file_name)
+        added = len(terms - self.automaton.terms)
+        removed = len(self.automaton.terms - terms)
+        self.automaton.update(terms)
+        if added or removed:
+            self.manager.print.print_to_logs(f"Banned terms updated: {added} added, {removed} removed "
+                                             f"({len(terms)} total)", self.manager.print.BRIGHT_PURPLE)
+
+    def scan(self, text):
+        if monotonic() >= self.next_refresh:
+            self.refresh()
+        if not self.automaton.terms:
+            return []
+        text = ' '.join(normalize_text(text).split())
+        found = []
+        for start, term in self.automaton.search(text):
+            end = start + len(term)
+            # Whole words only, so a banned word inside a longer harmless one is not flagged
+            if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                found.append(term)
+        if found:
+            self.matches += 1
+        return found
+
+    def check(self, message):
+        found = self.scan(message.parameters)
+        if found:
+            self.manager.print.print_to_logs(
+                f"Automod: {message.display_name} used banned terms ({', '.join(sorted(set(found)))}): "
+                f"{message.parameters}", self.manager.print.RED)
+        return len(found) > 0
+
+    def stats(self):
+        return {
+            'terms': len(self.automaton.terms),
+            'nodes': len(self.automaton.transitions),
+            'matches': self.matches
+        }
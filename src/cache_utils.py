@@ -0,0 +1,121 @@
+from collections import OrderedDict, deque
+from time import monotonic, time
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0
+        }
+
+
+class TTLCache(LRUCache):
+    def __init__(self, max_size, ttl):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time():
+            # Expired entries are dropped lazily, when they are looked up
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl=None):
+        super().put(key, (time() + (self.ttl if ttl is None else ttl), value))
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] > time()
+
+    def dump(self):
+        now = time()
+        return [[key, expires_at, value] for key, (expires_at, value) in self.entries.items() if expires_at > now]
+
+    def restore(self, entries):
+        now = time()
+        for key, expires_at, value in entries:
+            if expires_at > now:
+                self.entries[key] = (expires_at, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class DedupWindow:
+    # Remembers keys for ttl seconds, never more than max_size of them, so memory stays constant
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.order = deque()
+        self.keys = set()
+        self.hits = 0
+        self.misses = 0
+
+    def expire(self, now):
+        while self.order and (self.order[0][0] <= now or len(self.order) > self.max_size):
+            self.keys.discard(self.order.popleft()[1])
+
+    # True if the key was already seen inside the window, otherwise it is recorded
+    def seen(self, key):
+        now = monotonic()
+        self.expire(now)
+        if key in self.keys:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.keys.add(key)
+        self.order.append((now + self.ttl, key))
+        if len(self.order) > self.max_size:
+            self.expire(now)
+        return False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.keys),
+            'max_size': self.max_size,
+            'duplicates': self.hits,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0
+        }
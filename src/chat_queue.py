@@ -0,0 +1,117 @@
+from asyncio import PriorityQueue
+from itertools import count
+from time import monotonic
+
+from rate_limit import TokenBucket
+
+# Priority classes, the lowest is sent first
+MODERATION = 0
+REPLY = 1
+CHATTER = 2
+# Twitch rejects longer chat messages
+MESSAGE_LIMIT = 500
+# The same reply asked for again within this many seconds is only sent once
+COALESCE_WINDOW = 10
+# Twitch allows 20 messages every 30 seconds, 100 where the bot is a moderator or the broadcaster
+USER_LIMIT = 20
+MODERATOR_LIMIT = 100
+LIMIT_WINDOW = 30
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Cut on the last space before the limit, a single word longer than the limit is cut where it is
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+class OutboundQueue:
+    # Chat replies of one channel, sent by priority and paced by the rate limit of the bot's role there
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = PriorityQueue()
+        self.order = count()
+        self.moderator = False
+        # Only used while moderating, outside of that the account limit is shared by every channel of the bot
+        self.moderator_bucket = TokenBucket.for_window(MODERATOR_LIMIT, LIMIT_WINDOW)
+        self.recent = {}
+        self.sent = 0
+        self.requeued = 0
+        self.coalesced = 0
+        self.split = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def bucket(self):
+        return self.moderator_bucket if self.moderator else self.channel.bot.chat_bucket
+
+    def update_role(self, moderator):
+        if moderator != self.moderator:
+            self.moderator = moderator
+            self.channel.manager.print.print_to_logs(
+                f"{'Moderator' if moderator else 'User'} chat limits in #{self.channel.channel}",
+                self.channel.manager.print.BRIGHT_PURPLE)
+
+    def coalesce(self, key):
+        now = monotonic()
+        while self.recent:
+            oldest = next(iter(self.recent))
+            if now - self.recent[oldest] < COALESCE_WINDOW:
+                break
+            del self.recent[oldest]
+        if key in self.recent:
+            self.coalesced += 1
+            return True
+        self.recent[key] = now
+        return False
+
+    def put(self, text, target=None, priority=REPLY):
+        # Every offence gets its warning, only replies and chatter are coalesced
+        if priority != MODERATION and self.coalesce((target, text)):
+            return
+        prefix = f"/w {target} " if target else ''
+        parts = split_message(text, MESSAGE_LIMIT - len(prefix))
+        self.split += len(parts) - 1
+        for part in parts:
+            self.queue.put_nowait((priority, next(self.order), monotonic(),
+                                   f"PRIVMSG #{self.channel.channel} :{prefix}{part}"))
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            await self.channel.connection.ready.wait()
+            await self.bucket.acquire()
+            # Something more urgent may have arrived while waiting for a token
+            self.queue.put_nowait(item)
+            item = self.queue.get_nowait()
+            _, _, queued_at, line = item
+            if not await self.channel.send_chat(line):
+                # Its place in the queue is kept, it is the first line sent once the channel is joined again
+                self.queue.put_nowait(item)
+                self.requeued += 1
+                continue
+            waited = monotonic() - queued_at
+            self.wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.sent += 1
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'sent': self.sent,
+            'requeued': self.requeued,
+            'coalesced': self.coalesced,
+            'split': self.split,
+            'avg_wait_s': round(self.wait / self.sent, 2) if self.sent else 0,
+            'max_wait_s': round(self.max_wait, 2),
+            'moderator': self.moderator,
+            'bucket': self.bucket.stats()
+        }
@@ -0,0 +1,52 @@
+from time import monotonic
+
+# Expired cooldowns are only dropped when checked, past this many entries they are swept when a new one starts
+MAX_ENTRIES = 4096
+
+GLOBAL = 'global'
+COMMAND = 'command'
+USER = 'user'
+
+
+class Cooldowns:
+    # Cooldowns of one channel: each one stores the time and the message count it ends at, so the chat only
+    # moves a counter forward and a check never depends on how many cooldowns are running
+    def __init__(self):
+        self.messages = 0
+        self.entries = {}
+
+    def count(self, messages):
+        self.messages += messages
+
+    def remaining(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return 0, 0
+        wait_until, ready_at = entry
+        seconds = max(wait_until - monotonic(), 0)
+        messages = max(ready_at - self.messages, 0)
+        if not seconds and not messages:
+            del self.entries[key]
+        return seconds, messages
+
+    def blocking(self, keys):
+        for key in keys:
+            seconds, messages = self.remaining(key)
+            if seconds or messages:
+                return key, seconds, messages
+        return None
+
+    def start(self, key, seconds=0, messages=0):
+        if seconds <= 0 and messages <= 0:
+            return
+        if len(self.entries) >= MAX_ENTRIES:
+            # remaining() drops the ones that are over
+            for entry in list(self.entries):
+                self.remaining(entry)
+        self.entries[key] = (monotonic() + seconds, self.messages + messages)
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'active': len(self.entries)
+        }
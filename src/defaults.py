@@ -24,14 +24,16 @@ DEFAULT_COMMANDS = {
             "level": "ANY",
             "enabled": True,
             "timeout": 0,
-            "min_messages": 0
+            "min-messages": 0,
+            "user-timeout": 0
         },
         "hotpants": {
             "message": "You're the shit [sender]",
             "level": "MOD",
             "enabled": True,
             "timeout": 0,
-            "min_messages": 0
+            "min-messages": 0,
+            "user-timeout": 0
         }
     },
     "complex": {}
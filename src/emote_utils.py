@@ -0,0 +1,32 @@
+def parse_emote_ranges(emotes):
+    # emotes=25:0-4,12-16/1902:6-10, positions are code point indexes in the message
+    ranges = []
+    if isinstance(emotes, str):
+        for emote in emotes.split('/'):
+            for position in emote.partition(':')[2].split(','):
+                start, _, end = position.partition('-')
+                if start.isdigit() and end.isdigit():
+                    ranges.append((int(start), int(end)))
+    ranges.sort()
+    return ranges
+
+
+def strip_emotes(text, ranges, mode='collapse'):
+    # remove: drop every emote, collapse: keep one emote per run of the same emote
+    if not ranges or mode not in ('remove', 'collapse'):
+        return text
+    parts = []
+    last = 0
+    previous_emote = None
+    for start, end in ranges:
+        between = text[last:start]
+        if between.strip():
+            parts.append(between)
+            previous_emote = None
+        emote = text[start:end + 1]
+        if mode == 'collapse' and emote != previous_emote:
+            parts.append(f" {emote} ")
+        previous_emote = emote
+        last = end + 1
+    parts.append(text[last:])
+    return ' '.join(''.join(parts).split())
@@ -0,0 +1,234 @@
+import json
+from asyncio import Semaphore, create_task, gather, to_thread, wait_for
+from collections import deque
+from time import monotonic, time
+
+from reconnect import ConnectionSupervisor
+from twitch_eventsub_utils import EVENTSUB_URL, configured_subscriptions, create_subscription, \
+    open_session, drain_session, keepalive_timeout, subscription_condition, websocket_transport
+from http_client import json_body
+from twitch_helix import HelixClient
+from twitch_ircchat_utils import TWITCH_TOKEN_URL
+
+# Subscription requests sent at the same time, Helix still applies its own rate limit bucket on top
+MAX_CONCURRENT_SUBSCRIPTIONS = 10
+# Window used for the per shard event rate, in seconds
+RATE_WINDOW = 60
+
+
+class ConduitError(RuntimeError):
+    pass
+
+
+def checked_body(response, action):
+    body = json_body(response)
+    if response.status_code not in range(200, 299):
+        raise ConduitError(f"Could not {action}: {body.get('message', response.status_code)}")
+    return body
+
+
+class AppHelixClient(HelixClient):
+    # Conduits and their subscriptions only accept an app access token, obtained with the client credentials
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.app_token = None
+        self.app_token_expires = 0
+
+    def auth_headers(self):
+        return {
+            'Authorization': f"Bearer {self.app_token}",
+            'Client-Id': self.manager.configuration['twitch']['client_id']
+        }
+
+    async def refresh_app_token(self):
+        response = await to_thread(self.session.post, TWITCH_TOKEN_URL, timeout=self.timeout, data={
+            'client_id': self.manager.configuration['twitch']['client_id'],
+            'client_secret': self.manager.configuration['twitch']['client_secret'],
+            'grant_type': 'client_credentials'
+        })
+        token = checked_body(response, 'get an app access token (check the client secret)')
+        self.app_token = token['access_token']
+        self.app_token_expires = time() + token['expires_in']
+
+    async def send(self, method, url, **kwargs):
+        if self.app_token is None or time() >= self.app_token_expires - 60:
+            await self.refresh_app_token()
+        response = await super().send(method, url, **kwargs)
+        if response.status_code == 401:
+            await self.refresh_app_token()
+            response = await super().send(method, url, **kwargs)
+        return response
+
+    async def get_conduits(self):
+        response = await self.request('GET', '/eventsub/conduits')
+        return json_body(response).get('data', []) if response.status_code in range(200, 299) else []
+
+    async def create_conduit(self, shard_count):
+        response = await self.request('POST', '/eventsub/conduits', json={'shard_count': shard_count})
+        return checked_body(response, 'create the EventSub conduit')['data'][0]
+
+    async def update_conduit(self, conduit_id, shard_count):
+        response = await self.request('PATCH', '/eventsub/conduits',
+                                      json={'id': conduit_id, 'shard_count': shard_count})
+        return checked_body(response, f"resize the EventSub conduit {conduit_id}")['data'][0]
+
+    async def update_shards(self, conduit_id, shards):
+        response = await self.request('PATCH', '/eventsub/conduits/shards',
+                                      json={'conduit_id': conduit_id, 'shards': shards})
+        body = json_body(response)
+        if response.status_code not in range(200, 299):
+            return [{'id': shard['id'], 'message': body.get('message', response.status_code)} for shard in shards]
+        return body.get('errors', [])
+
+
+class EventSubShard:
+    def __init__(self, conduit, shard_id):
+        self.conduit = conduit
+        self.bot = conduit.bot
+        self.shard_id = shard_id
+        self.websocket = None
+        self.session_id = None
+        self.events = 0
+        self.recent = deque()
+        self.supervisor = ConnectionSupervisor(f"EventSub shard {shard_id}", self.connection, self.bot.manager,
+                                               self.bot.shutdown)
+
+    def record(self):
+        now = monotonic()
+        self.events += 1
+        self.recent.append(now)
+        while self.recent[0] <= now - RATE_WINDOW:
+            self.recent.popleft()
+
+    def handle_message(self, message):
+        if message['metadata']['message_type'] == 'notification':
+            self.record()
+        self.bot.handle_eventsub_message(message)
+
+    async def connection(self):
+        self.websocket, session = await open_session(self.bot, EVENTSUB_URL)
+        timeout = keepalive_timeout(session)
+        try:
+            # A shard that dropped is pointed at its new session, Twitch balances events over the enabled ones
+            await self.conduit.assign(self, session['id'])
+            self.supervisor.connected()
+            while not self.bot.shutdown.is_set():
+                message = json.loads(await wait_for(self.websocket.recv(), timeout))
+                if message['metadata']['message_type'] == 'session_reconnect':
+                    old_websocket = self.websocket
+                    self.websocket, session = await open_session(self.bot,
+                                                                 message['payload']['session']['reconnect_url'])
+                    timeout = keepalive_timeout(session)
+                    await self.conduit.assign(self, session['id'])
+                    self.supervisor.handed_over()
+                    await drain_session(self.bot, old_websocket)
+                else:
+                    self.handle_message(message)
+        finally:
+            await self.websocket.close()
+
+    def stats(self):
+        now = monotonic()
+        while self.recent and self.recent[0] <= now - RATE_WINDOW:
+            self.recent.popleft()
+        return {
+            'session_id': self.session_id,
+            'events': self.events,
+            'events_per_min': len(self.recent) * 60 / RATE_WINDOW,
+            **self.supervisor.stats()
+        }
+
+
+class EventSubConduit:
+    def __init__(self, bot, shard_count):
+        self.bot = bot
+        self.manager = bot.manager
+        self.helix = AppHelixClient(bot.manager)
+        self.conduit_id = None
+        self.shards = [EventSubShard(self, str(idx)) for idx in range(shard_count)]
+
+    async def setup(self):
+        # Conduits outlive the process, an existing one is reused and resized instead of creating another
+        conduits = await self.helix.get_conduits()
+        if not conduits:
+            conduit = await self.helix.create_conduit(len(self.shards))
+        elif conduits[0]['shard_count'] != len(self.shards):
+            conduit = await self.helix.update_conduit(conduits[0]['id'], len(self.shards))
+        else:
+            conduit = conduits[0]
+        self.conduit_id = conduit['id']
+        self.manager.print.print_to_logs(f"Using EventSub conduit {self.conduit_id} with {len(self.shards)} shards",
+                                         self.manager.print.BRIGHT_PURPLE)
+
+    async def assign(self, shard, session_id):
+        shard.session_id = session_id
+        errors = await self.helix.update_shards(self.conduit_id, [
+            {'id': shard.shard_id, 'transport': websocket_transport(session_id)}
+        ])
+        for error in errors:
+            self.manager.print.print_to_logs(f"Could not assign shard {error['id']}: {error['message']}",
+                                             self.manager.print.RED)
+
+    async def broadcasters(self):
+        logins = self.manager.configuration['eventsub']['channels'] or ','.join(self.bot.configured_channels)
+        logins = [login.strip().lower() for login in logins.split(',') if login.strip()]
+        return await self.manager.helix.get_users(logins=logins)
+
+    async def reconcile(self):
+        wanted = configured_subscriptions(self.bot)
+        broadcasters = await self.broadcasters()
+        existing = await self.helix.get_eventsub_subscriptions()
+        user_id = self.bot.user['id']
+        active = set()
+        for subscription in existing:
+            if subscription['transport'].get('conduit_id') == self.conduit_id and subscription['status'] == 'enabled':
+                active.add((subscription['type'], frozenset(subscription['condition'].items())))
+        missing = {}
+        for broadcaster in broadcasters:
+            for subscription_type in wanted:
+                key = (subscription_type, frozenset(
+                    subscription_condition(subscription_type, broadcaster['id'], user_id).items()))
+                # Subscriptions on the bot's own account (whispers) are the same for every channel
+                if key not in active:
+                    missing.setdefault(key, (subscription_type, broadcaster['id']))
+        semaphore = Semaphore(MAX_CONCURRENT_SUBSCRIPTIONS)
+        transport = {'method': 'conduit', 'conduit_id': self.conduit_id}
+
+        async def subscribe(subscription_type, broadcaster_id):
+            async with semaphore:
+                return await create_subscription(self.bot, self.helix, subscription_type, broadcaster_id, user_id,
+                                                 transport)
+
+        results = await gather(*(subscribe(subscription_type, broadcaster_id)
+                                 for subscription_type, broadcaster_id in missing.values()))
+        created = sum(1 for result in results if result)
+        self.manager.print.print_to_logs(f"EventSub conduit: {len(broadcasters)} channels, {created} subscriptions "
+                                         f"created, {len(active)} already active, {len(missing) - created} failed",
+                                         self.manager.print.BRIGHT_PURPLE)
+
+    async def run(self):
+        shards = []
+        try:
+            await self.setup()
+            # The shards start connecting first, so the subscriptions soon have somewhere to deliver to
+            shards = [create_task(shard.supervisor.run()) for shard in self.shards]
+            await self.reconcile()
+            await gather(*shards)
+        except ConduitError as e:
+            # Chat keeps running without events, the conduit only starts again with the bot
+            self.manager.print.print_to_logs(f"EventSub conduit stopped: {e}", self.manager.print.RED)
+        finally:
+            for shard in shards:
+                shard.cancel()
+
+    async def close(self):
+        for shard in self.shards:
+            if shard.websocket is not None:
+                await shard.websocket.close()
+        self.helix.close()
+
+    def stats(self):
+        return {
+            'conduit_id': self.conduit_id,
+            'shards': {shard.shard_id: shard.stats() for shard in self.shards}
+        }
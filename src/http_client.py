@@ -0,0 +1,136 @@
+import random
+import re
+from asyncio import create_task, shield, sleep, to_thread
+from time import monotonic
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 5
+# 429/5xx handling: how many times a request is retried and the longest wait we are willing to honour
+MAX_RETRIES = 3
+MAX_RETRY_AFTER = 30
+BACKOFF_BASE = 0.5
+# Path segments that look like ids are grouped, so /tracks/<id> is counted as a single endpoint
+ID_SEGMENT_PATTERN = re.compile(r'/[A-Za-z0-9]{16,}(?=/|$)')
+
+
+def endpoint_name(method, url):
+    return f"{method} {ID_SEGMENT_PATTERN.sub('/{id}', urlsplit(url).path)}"
+
+
+def retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    try:
+        delay = float(retry_after) if retry_after is not None else BACKOFF_BASE * 2 ** attempt
+    except ValueError:
+        delay = BACKOFF_BASE * 2 ** attempt
+    # Jitter, so waiting requests do not all fire again in the same instant
+    return min(delay, MAX_RETRY_AFTER) + random.uniform(0, BACKOFF_BASE)
+
+
+def json_body(response, default=None):
+    # Error pages from proxies and outages are not always JSON
+    try:
+        return response.json()
+    except ValueError:
+        return {} if default is None else default
+
+
+class RequestScheduler:
+    def __init__(self, on_throttled=None):
+        self.on_throttled = on_throttled
+        self.in_flight = {}
+        # Every request waits while the API told us to back off, not only the one that got the 429
+        self.blocked_until = 0
+        self.counters = {}
+
+    def count(self, endpoint, counter):
+        counters = self.counters.get(endpoint)
+        if counters is None:
+            counters = self.counters[endpoint] = {'requests': 0, 'coalesced': 0, 'throttled': 0, 'errors': 0}
+        counters[counter] += 1
+
+    async def submit(self, send, method, url, **kwargs):
+        endpoint = endpoint_name(method, url)
+        if method != 'GET':
+            return await self.send(send, endpoint, method, url, **kwargs)
+
+        # Identical GETs already on their way share the same response
+        key = (url, repr(sorted((kwargs.get('params') or {}).items())))
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.count(endpoint, 'coalesced')
+        else:
+            task = create_task(self.send(send, endpoint, method, url, **kwargs))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded, so a caller being cancelled does not cancel the request for everyone else
+        return await shield(task)
+
+    async def send(self, send, endpoint, method, url, **kwargs):
+        attempt = 0
+        while True:
+            delay = self.blocked_until - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            self.count(endpoint, 'requests')
+            try:
+                response = await send(method, url, **kwargs)
+            except requests.RequestException:
+                self.count(endpoint, 'errors')
+                raise
+            if attempt >= MAX_RETRIES or (response.status_code != 429 and response.status_code < 500):
+                if response.status_code >= 400:
+                    self.count(endpoint, 'errors')
+                return response
+
+            delay = retry_delay(response, attempt)
+            attempt += 1
+            if response.status_code == 429:
+                self.count(endpoint, 'throttled')
+                self.blocked_until = max(self.blocked_until, monotonic() + delay)
+                if self.on_throttled is not None:
+                    self.on_throttled(endpoint, delay)
+            else:
+                await sleep(delay)
+
+    def stats(self):
+        return {
+            'in_flight': len(self.in_flight),
+            'blocked_for': round(max(0.0, self.blocked_until - monotonic()), 1),
+            'endpoints': {endpoint: dict(counters) for endpoint, counters in self.counters.items()}
+        }
+
+
+class AsyncHttpClient:
+    base_url = ''
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=10, scheduler=None):
+        self.timeout = timeout
+        self.scheduler = scheduler
+        # One keep-alive session per API, so calls reuse the TLS connection instead of handshaking every time
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def auth_headers(self):
+        return {}
+
+    def build_url(self, url):
+        return url if url.startswith('https://') else f"{self.base_url}{url}"
+
+    async def request(self, method, url, **kwargs):
+        if self.scheduler is not None:
+            return await self.scheduler.submit(self.send, method, self.build_url(url), **kwargs)
+        return await self.send(method, self.build_url(url), **kwargs)
+
+    async def send(self, method, url, timeout=None, headers=None, **kwargs):
+        # Headers are built on every attempt, so a retry picks up a token refreshed in the meantime
+        headers = {**self.auth_headers(), **(headers or {})}
+        # requests is blocking, the call runs in a worker thread to keep the event loop free
+        return await to_thread(self.session.request, method, url, headers=headers,
+                               timeout=timeout or self.timeout, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,234 @@
+import os
+from itertools import count
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic, perf_counter
+
+import ai_helper
+from ai_helper import BACKENDS, TorchBackend, load_model
+from manager_utils import PrintColors
+
+# Shared memory given to each client: the UTF-8 texts of a batch, then one float32 pair of scores per text
+SLOT_SIZE = 256 * 1024
+RESULTS_OFFSET = SLOT_SIZE - 4 * 1024
+MAX_TEXTS = (SLOT_SIZE - RESULTS_OFFSET) // 8
+# The first start may download the model, later requests only wait for a batch
+READY_TIMEOUT = 10 * 60
+REQUEST_TIMEOUT = 30
+STATS_INTERVAL = 5
+
+# Set in every process that scores through the shared inference process, read by RemoteBackend.load()
+slot = None
+
+
+def attach(name, connection):
+    global slot
+    slot = InferenceSlot(name, connection)
+
+
+def detach():
+    global slot
+    if slot is not None:
+        slot.close()
+        slot = None
+
+
+def score_view(memory, rows):
+    import numpy
+    return numpy.ndarray((rows, 2), dtype=numpy.float32, buffer=memory.buf, offset=RESULTS_OFFSET)
+
+
+class InferenceSlot:
+    # One client's window on the inference process: the texts are written straight into shared memory,
+    # only their lengths travel over the pipe and the scores are read back from the same block
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self.memory = None
+        # Replies meant for a previous process on this slot (a restarted worker) are told apart by the pid
+        self.request_ids = ((os.getpid(), idx) for idx in count())
+
+    def open(self):
+        if self.memory is None:
+            self.memory = SharedMemory(name=self.name)
+        while self.connection.poll():
+            self.connection.recv()
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+
+    def call(self, message, timeout):
+        request_id = next(self.request_ids)
+        self.connection.send((message[0], request_id, *message[1:]))
+        deadline = monotonic() + timeout
+        while self.connection.poll(max(deadline - monotonic(), 0)):
+            reply = self.connection.recv()
+            if reply[1] != request_id:
+                continue
+            if reply[0] == 'error':
+                raise RuntimeError(reply[2])
+            return reply[2]
+        raise TimeoutError(f"No answer from the inference process in {timeout}s")
+
+    def wait_ready(self):
+        return self.call(('ping',), READY_TIMEOUT)
+
+    def chunks(self, encoded):
+        chunk = []
+        size = 0
+        for data in encoded:
+            if chunk and (size + len(data) > RESULTS_OFFSET or len(chunk) == MAX_TEXTS):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(data)
+            size += len(data)
+        if chunk:
+            yield chunk
+
+    def score(self, texts):
+        import numpy
+        # Chat lines are far below the slot size, anything longer is cut rather than split over requests
+        encoded = [text.encode('utf-8')[:RESULTS_OFFSET] for text in texts]
+        results = []
+        for chunk in self.chunks(encoded):
+            offset = 0
+            for data in chunk:
+                self.memory.buf[offset:offset + len(data)] = data
+                offset += len(data)
+            rows = self.call(('score', [len(data) for data in chunk]), REQUEST_TIMEOUT)
+            results.append(score_view(self.memory, rows).copy())
+        return numpy.concatenate(results)
+
+
+class RemoteBackend:
+    # Scores through the shared inference process instead of loading a model in this one
+    name = 'remote'
+
+    def __init__(self):
+        self.slot = slot
+        self.server_backend = None
+
+    def load(self):
+        if self.slot is None:
+            raise ImportError('no shared inference process was started')
+        self.slot.open()
+        self.server_backend = self.slot.wait_ready()
+
+    def predict(self, messages):
+        return self.slot.score(messages)
+
+
+BACKENDS[RemoteBackend.name] = RemoteBackend
+
+
+class InferenceServer:
+    # Runs in its own process, the model is loaded once and the batches of all the clients are scored together
+    def __init__(self, backend_name, slots, status):
+        self.backend_name = backend_name
+        self.slots = slots
+        self.status = status
+        self.print = PrintColors()
+        self.memories = {}
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+        self.busy = 0.0
+        self.started_at = monotonic()
+
+    def load(self):
+        start = perf_counter()
+        for candidate in dict.fromkeys((self.backend_name, TorchBackend.name)):
+            try:
+                load_model(candidate)
+                self.backend_name = candidate
+                break
+            except ImportError as e:
+                self.print.print_to_logs(f"Toxicity backend {candidate} not available: {e}", self.print.YELLOW)
+        else:
+            raise RuntimeError('No toxicity backend could be loaded')
+        self.print.print_to_logs(f"Inference process loaded {self.backend_name} in {perf_counter() - start:.2f}s "
+                                 f"for {len(self.slots)} clients", self.print.GREEN)
+
+    def read_texts(self, memory, lengths):
+        texts = []
+        offset = 0
+        for length in lengths:
+            # Decoded straight from the shared block, the bytes are never copied into the process first
+            texts.append(str(memory.buf[offset:offset + length], 'utf-8', 'ignore'))
+            offset += length
+        return texts
+
+    def score(self, requests):
+        texts = []
+        for connection, _, lengths in requests:
+            texts.extend(self.read_texts(self.memories[connection], lengths))
+        start = perf_counter()
+        try:
+            probabilities = ai_helper.backend.predict(texts)
+        except Exception as e:
+            for connection, request_id, _ in requests:
+                connection.send(('error', request_id, str(e)))
+            return
+        self.busy += perf_counter() - start
+        self.batches += 1
+        self.requests += len(requests)
+        self.texts += len(texts)
+        offset = 0
+        for connection, request_id, lengths in requests:
+            view = score_view(self.memories[connection], len(lengths))
+            view[:] = probabilities[offset:offset + len(lengths)]
+            del view
+            offset += len(lengths)
+            connection.send(('done', request_id, len(lengths)))
+
+    def run(self):
+        self.memories = {connection: SharedMemory(name=name) for name, connection in self.slots}
+        self.load()
+        self.status.send(('ready', self.stats()))
+        next_stats = monotonic() + STATS_INTERVAL
+        try:
+            while self.memories:
+                requests = []
+                # Every client with something pending is answered from the same forward pass
+                for connection in wait(list(self.memories), STATS_INTERVAL):
+                    try:
+                        message = connection.recv()
+                    except EOFError:
+                        self.memories.pop(connection).close()
+                        continue
+                    match message[0]:
+                        case 'ping':
+                            connection.send(('ready', message[1], self.backend_name))
+                        case 'score':
+                            requests.append((connection, message[1], message[2]))
+                if requests:
+                    self.score(requests)
+                if monotonic() >= next_stats:
+                    self.status.send(('stats', self.stats()))
+                    next_stats = monotonic() + STATS_INTERVAL
+        finally:
+            for memory in self.memories.values():
+                memory.close()
+
+    def stats(self):
+        uptime = monotonic() - self.started_at
+        return {
+            'pid': os.getpid(),
+            'backend': self.backend_name,
+            'clients': len(self.memories),
+            'batches': self.batches,
+            'requests': self.requests,
+            'texts': self.texts,
+            'avg_batch': round(self.texts / self.batches, 1) if self.batches else 0,
+            'busy_ratio': round(self.busy / uptime, 3) if uptime else 0
+        }
+
+
+def serve(backend_name, slots, status):
+    try:
+        InferenceServer(backend_name, slots, status).run()
+    except KeyboardInterrupt:
+        pass
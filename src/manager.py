@@ -2,21 +2,30 @@ import json
 import platform
 import secrets
 import sys
-from asyncio import create_task, run, CancelledError, sleep, gather, Event
+from asyncio import create_task, run, CancelledError, sleep, gather, Event, to_thread
+from multiprocessing import freeze_support
 from datetime import timedelta
 from os import path, mkdir, chdir
 from queue import Queue
+from time import perf_counter
 from webbrowser import open as wbopen
 
 import uvicorn
 from websockets import ConnectionClosedOK
 
+from ai_helper import ToxicityAnalyser
+from automod import BannedTermMatcher
 from manager_utils import PrintColors, load_configuration_from_json, save_configuration_to_json, return_date_string, \
-    check_dict_structure, is_string_valid, check_token_expiry, is_token_config_invalid, reset_token_config
+    check_dict_structure, is_string_valid, check_token_expiry, is_token_config_invalid, reset_token_config, resource_path
+from now_playing import NowPlayingPoller
+from prefilter import Prefilter
 from quart_server import QuartServer
-from spotify import start_spotify_oauth_flow, refresh_spotify_token
+from song_queue import SongQueue
+from spotify import SpotifyClient, start_spotify_oauth_flow, refresh_spotify_token
+from supervisor import ProcessSupervisor
 from translations import TranslationManager
 from twitch import TwitchWebSocketManager
+from twitch_helix import HelixClient
 from twitch_ircchat_utils import start_twitch_oauth_flow, refresh_twitch_token
 
 # Files Location
@@ -25,6 +34,7 @@ CONFIG_FILE = 'config/config.json'
 
 class Manager:
     def __init__(self):
+        self.startup_time = perf_counter()
         self.quart = None
         self.bot = None
         self.verify = None
@@ -55,12 +65,49 @@ class Manager:
                 'access_token': None,
                 'refresh_token': None,
                 'expires_in': None
+            },
+            'spotify-cache': {
+                'max_size': None,
+                'search_ttl': None,
+                'track_ttl': None,
+                'persist': None
+            },
+            'eventsub': {
+                'events': None,
+                'conduit_shards': None,
+                'channels': None
+            },
+            'irc': {
+                'channels': None,
+                'channels_per_connection': None
+            },
+            'queue': {
+                'max_per_user': None,
+                'max_batch': None
+            },
+            'supervisor': {
+                'workers': None
+            },
+            'commands': {
+                'global_timeout': None
+            },
+            'ai': {
+                'backend': None,
+                'max_batch_size': None,
+                'max_latency_ms': None,
+                'cache_size': None,
+                'min_length': None,
+                'emote_mode': None,
+                'shed_queue_depth': None,
+                'shed_latency_ms': None,
+                'sample_rate': None
             }
         }
         self.tasks = {
             'bot': None,
             'quart': None,
-            'updater': None
+            'updater': None,
+            'supervisor': None
         }
         self.translation_manager = TranslationManager(self)
         self.authentication_flag = Event()
@@ -68,6 +115,15 @@ class Manager:
         self.quart = QuartServer(self)
         self.print = PrintColors()
         self.startup_checks()
+        self.analyser = ToxicityAnalyser(self)
+        self.prefilter = Prefilter(self)
+        self.automod = BannedTermMatcher(self)
+        self.spotify = SpotifyClient(self)
+        self.now_playing = NowPlayingPoller(self)
+        self.song_queue = SongQueue(self)
+        self.helix = HelixClient(self)
+        # Only in supervisor mode, the extra channels then run in worker processes
+        self.supervisor = ProcessSupervisor(self) if int(self.configuration['supervisor']['workers']) > 0 else None
 
     def startup_checks(self):
         if not path.exists('config'):
@@ -86,6 +142,8 @@ class Manager:
         self.setup()
         # self.save_config()
         self.print.print_to_logs('Configuration Loaded', self.print.GREEN)
+        self.print.print_to_logs(f"Startup completed in {perf_counter() - self.startup_time:.2f}s",
+                                 self.print.BRIGHT_PURPLE)
 
     def setup(self):
         sections = {
@@ -93,12 +151,21 @@ class Manager:
             'twitch': ['channel', 'client_id', 'client_secret'],
             'spotify': ['client_id', 'redirect_uri'],
             'twitch-token': ['access_token', 'refresh_token', 'expires_in', 'timestamp'],
-            'spotify-token': ['access_token', 'refresh_token', 'expires_in', 'timestamp']
+            'spotify-token': ['access_token', 'refresh_token', 'expires_in', 'timestamp'],
+            'spotify-cache': ['max_size', 'search_ttl', 'track_ttl', 'persist'],
+            'eventsub': ['events', 'conduit_shards', 'channels'],
+            'irc': ['channels', 'channels_per_connection'],
+            'queue': ['max_per_user', 'max_batch'],
+            'supervisor': ['workers'],
+            'commands': ['global_timeout'],
+            'ai': ['backend', 'max_batch_size', 'max_latency_ms', 'cache_size', 'min_length', 'emote_mode',
+                   'shed_queue_depth', 'shed_latency_ms', 'sample_rate']
         }
 
         missing_keys = check_dict_structure(self.configuration, sections)
         if len(missing_keys) > 0:
             for section, item in missing_keys:
+                self.configuration.setdefault(section, {})
                 match item:
                     case 'last_opened':
                         self.configuration[section][item] = return_date_string()
@@ -106,6 +173,50 @@ class Manager:
                         self.configuration[section][item] = 'https://localhost:5000/callback'
                     case 'selected_language':
                         self.configuration[section][item] = 'en'
+                    case 'max_size':
+                        self.configuration[section][item] = 1024
+                    case 'search_ttl':
+                        self.configuration[section][item] = 6 * 60 * 60
+                    case 'track_ttl':
+                        self.configuration[section][item] = 24 * 60 * 60
+                    case 'persist':
+                        self.configuration[section][item] = True
+                    case 'events':
+                        # 'all' or a comma separated list of subscription types
+                        self.configuration[section][item] = 'all'
+                    case 'conduit_shards':
+                        # 0 keeps a single EventSub websocket session for the bot's own channel
+                        self.configuration[section][item] = 0
+                    case 'channels_per_connection':
+                        self.configuration[section][item] = 25
+                    case 'max_per_user':
+                        self.configuration[section][item] = 3
+                    case 'max_batch':
+                        self.configuration[section][item] = 50
+                    case 'global_timeout':
+                        # Seconds between any two commands in a channel, 0 leaves only the per command cooldowns
+                        self.configuration[section][item] = 0
+                    case 'workers':
+                        # 0 runs every channel in this process
+                        self.configuration[section][item] = 0
+                    case 'backend':
+                        self.configuration[section][item] = 'pytorch'
+                    case 'max_batch_size':
+                        self.configuration[section][item] = 16
+                    case 'max_latency_ms':
+                        self.configuration[section][item] = 50
+                    case 'cache_size':
+                        self.configuration[section][item] = 2048
+                    case 'min_length':
+                        self.configuration[section][item] = 3
+                    case 'emote_mode':
+                        self.configuration[section][item] = 'collapse'
+                    case 'shed_queue_depth':
+                        self.configuration[section][item] = 64
+                    case 'shed_latency_ms':
+                        self.configuration[section][item] = 2000
+                    case 'sample_rate':
+                        self.configuration[section][item] = 0.1
                     case _:
                         if section in ('twitch', 'spotify'):
                             self.needed_values.append((section, item))
@@ -137,14 +248,7 @@ class Manager:
         except CancelledError:
             pass
 
-    @staticmethod
-    def resource_path(relative_path):
-        try:
-            base_path = sys._MEIPASS
-        except Exception:
-            # base_path = path.sep.join(sys.argv[0].split(path.sep)[:-1])
-            base_path = path.abspath('.')
-        return str(path.join(base_path, relative_path))
+    resource_path = staticmethod(resource_path)
 
     def reset_tokens_step(self):
         self.print.print_to_logs('Do you want to reset the tokens? [Y/]', self.print.WHITE)
@@ -189,8 +293,15 @@ class Manager:
                 pass
             except ConnectionClosedOK:
                 pass
-        self.bot = TwitchWebSocketManager(self)
-        self.tasks['bot'] = await create_task(self.bot.run())
+        if self.supervisor is not None:
+            # Workers may have been started before the tokens were checked
+            self.supervisor.update_tokens()
+            self.bot = TwitchWebSocketManager(self, channels=self.supervisor.local_channels(),
+                                              share=self.supervisor.limit_share)
+        else:
+            self.bot = TwitchWebSocketManager(self)
+        # The supervised bot only returns on shutdown, it is gathered by main() instead of awaited here
+        self.tasks['bot'] = create_task(self.bot.run())
 
     async def check_spotify(self):
         self.print.print_to_logs('Spotify sanity check!', self.print.BRIGHT_PURPLE)
@@ -252,6 +363,14 @@ class Manager:
         self.shutdown_flag.set()
         self.print.print_to_logs('Initiating shutdown...', self.print.BRIGHT_PURPLE)
         await self.bot.close()
+        await self.analyser.stop()
+        if self.supervisor is not None:
+            await to_thread(self.supervisor.stop)
+        await self.now_playing.stop()
+        self.spotify.save_cache()
+        self.spotify.close()
+        self.song_queue.close()
+        self.helix.close()
         self.tasks['updater'].cancel()
         self.save_config()
         self.print.print_to_logs('Cleanup complete. Exiting...', self.print.BRIGHT_PURPLE)
@@ -271,11 +390,18 @@ class Manager:
             self.authentication_flag.set()
             wbopen('https://localhost:5000/setup')
             await self.await_authentication()
+        # Started before the token checks, which may create the bot themselves
+        if self.supervisor is not None:
+            self.supervisor.start()
+            self.tasks['supervisor'] = create_task(self.supervisor.run())
+        self.analyser.start()
+        self.now_playing.start()
         await self.check_tokens()
         if self.bot is None and self.tasks['bot'] is None:
             await self.create_new_bot()
         self.tasks['updater'] = await create_task(self.core_loop())
-        tasks = [self.tasks['quart'], self.tasks['updater'], self.tasks['bot']]
+        tasks = [task for task in (self.tasks['quart'], self.tasks['updater'], self.tasks['bot'],
+                                   self.tasks['supervisor']) if task is not None]
         try:
             await gather(*tasks)
         except CancelledError:
@@ -283,6 +409,8 @@ class Manager:
 
 
 if __name__ == '__main__':
+    # Worker processes are spawned, a frozen executable has to hand them over before doing anything else
+    freeze_support()
     if platform.system() == 'Darwin':
         chdir(path.sep.join(sys.argv[0].split(path.sep)[:-1]))
     manager = Manager()
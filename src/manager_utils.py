@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 from datetime import datetime
 from time import time
 
@@ -36,6 +37,15 @@ class PrintColors:
             self.log_queue = []
         new_print(message, color)
 
+    def print_batch_to_logs(self, messages, color):
+        current_date = datetime.now().strftime('%d-%m-%Y')
+        file_name = f"logs/logs-{current_date}.txt"
+        if len(self.log_queue) > 0:
+            for msg, msg_color in self.log_queue:
+                new_print(msg, msg_color)
+            self.log_queue = []
+        new_batch_print(messages, color, file_name)
+
 
 def new_print(message, color):
     # Get current timestamp in the specified format
@@ -52,6 +62,16 @@ def new_print(message, color):
         file.write(log_entry)
 
 
+def new_batch_print(messages, color, file_name):
+    # Same format as new_print, but the log file is opened once for the whole batch
+    timestamp = datetime.now().strftime('%d/%m/%y - %H:%M')
+    level = get_level_from_color(color)
+    for message in messages:
+        print(f"{timestamp} | {color}{level}{PrintColors.WHITE}: {color}{message}{PrintColors.WHITE}")
+    with open(file_name, 'a', encoding='utf-8') as file:
+        file.write(''.join(f"{timestamp} | {level}: {message}\n" for message in messages))
+
+
 def get_level_from_color(color):
     match color:
         case PrintColors.RED:
@@ -70,6 +90,15 @@ def get_level_from_color(color):
             return 'EVENT'
 
 
+def resource_path(relative_path):
+    try:
+        base_path = sys._MEIPASS
+    except Exception:
+        # base_path = path.sep.join(sys.argv[0].split(path.sep)[:-1])
+        base_path = os.path.abspath('.')
+    return str(os.path.join(base_path, relative_path))
+
+
 def save_configuration_to_json(self, filename):
     with open(filename, 'w', encoding='utf-8') as f:
         json.dump(self.configuration, f, indent=4)
@@ -153,7 +182,7 @@ def process_form(form_data):
         # Initialize the second level of nesting
         if command_name not in commands[section]:
             commands[section][command_name] = {}
-        if attribute in ['timeout', 'min-messages']:
+        if attribute in ['timeout', 'min-messages', 'user-timeout']:
             commands[section][command_name][attribute] = int(value)
         else:
             commands[section][command_name][attribute] = value
@@ -0,0 +1,107 @@
+from asyncio import Queue, QueueEmpty, QueueFull, Event, create_task, wait_for, CancelledError
+
+# Poll interval while nothing is playing or the track is far from its end, in seconds
+IDLE_DELAY = 30
+ERROR_DELAY = 10
+
+
+def parse_current_track(track):
+    if not track or not track.get('item'):
+        return None
+    item = track['item']
+    return {
+        'id': item['id'],
+        'track_name': item['name'],
+        'artist_name': item['artists'][0]['name'],
+        'album_name': item['album']['name'],
+        'album_image_url': item['album']['images'][0]['url'] if item['album']['images'] else None,
+        'duration_ms': int(item['duration_ms']),
+        'progress_ms': int(track['progress_ms'] or 0),
+        'is_playing': track.get('is_playing', False)
+    }
+
+
+def next_poll_delay(state):
+    if state is None or not state['is_playing']:
+        return IDLE_DELAY
+    remaining = state['duration_ms'] - state['progress_ms']
+    if remaining >= IDLE_DELAY * 1000:
+        return IDLE_DELAY
+    return (remaining / 1000) + 2  # Convert to seconds and adds 2 seconds
+
+
+class NowPlayingPoller:
+    def __init__(self, manager):
+        self.manager = manager
+        self.state = None
+        self.subscribers = set()
+        self.task = None
+        self.wake = Event()
+
+    def start(self):
+        if self.task is None:
+            self.task = create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except CancelledError:
+                pass
+            self.task = None
+
+    def refresh(self):
+        # Skip the wait and poll right away, e.g. after a skip/play/pause command
+        self.wake.set()
+
+    async def run(self):
+        while True:
+            delay = await self.poll()
+            try:
+                await wait_for(self.wake.wait(), delay)
+            except TimeoutError:
+                pass
+            self.wake.clear()
+
+    async def poll(self):
+        try:
+            track = await self.manager.spotify.get_current_track()
+        except CancelledError:
+            raise
+        except Exception as e:
+            self.manager.print.print_to_logs(f"Could not retrieve the current track: {e}", self.manager.print.YELLOW)
+            return ERROR_DELAY
+        state = parse_current_track(track)
+        if self.has_changed(state):
+            self.broadcast(state)
+            if state is not None:
+                self.manager.song_queue.advance(state['id'])
+        self.state = state
+        return next_poll_delay(state)
+
+    def has_changed(self, state):
+        if state is None or self.state is None:
+            return state is not self.state
+        return state['id'] != self.state['id'] or state['is_playing'] != self.state['is_playing']
+
+    def subscribe(self):
+        queue = Queue(maxsize=8)
+        queue.put_nowait(self.state)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def broadcast(self, state):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(state)
+            except QueueFull:
+                # A slow client only needs the latest state
+                try:
+                    queue.get_nowait()
+                except QueueEmpty:
+                    pass
+                queue.put_nowait(state)
@@ -0,0 +1,56 @@
+import re
+
+from emote_utils import parse_emote_ranges
+from twitch_commands import URL_PATTERN
+
+# Verdicts of the cheap stage, only MODEL messages reach the transformer
+# Banned terms are caught before this stage by the automod (config/banned_terms.txt)
+SKIP = 'skip'
+MODEL = 'model'
+
+
+def is_emote_only(message, text):
+    if message.tags.get('emote-only'):
+        return True
+    ranges = parse_emote_ranges(message.tags.get('emotes'))
+    if not ranges:
+        return False
+    covered = sum(end - start + 1 for start, end in ranges)
+    return covered >= len(text) - text.count(' ')
+
+
+class Prefilter:
+    def __init__(self, manager):
+        self.manager = manager
+        self.counters = {
+            'emote_only': 0,
+            'short': 0,
+            'url': 0,
+            'model': 0
+        }
+
+    @property
+    def min_length(self):
+        return int(self.manager.configuration['ai']['min_length'])
+
+    def classify(self, message):
+        text = message.parameters.strip()
+        if is_emote_only(message, message.parameters):
+            return self.count(SKIP, 'emote_only')
+        if len(text) < self.min_length:
+            return self.count(SKIP, 'short')
+        if len(re.sub(URL_PATTERN, '', text).strip()) < self.min_length:
+            return self.count(SKIP, 'url')
+        return self.count(MODEL, 'model')
+
+    def count(self, verdict, stage):
+        self.counters[stage] += 1
+        return verdict, stage
+
+    def stats(self):
+        total = sum(self.counters.values())
+        return {
+            'total': total,
+            'counters': self.counters,
+            'fractions': {stage: count / total if total > 0 else 0.0 for stage, count in self.counters.items()}
+        }
@@ -1,31 +1,23 @@
 import json
 import sys
-from asyncio import CancelledError
+from asyncio import CancelledError, to_thread
 from os import path
 from time import time
 
 from quart import Quart, request, Response, redirect, send_from_directory, render_template_string
 
 from manager_utils import is_string_valid, process_form
-from spotify import get_token, get_current_track
+from spotify import get_token
 from templates import DEFAULT_FIRST_TIME_CONFIGURATION_HTML, DEFAULT_COMMANDS_HTML, \
-    DEFAULT_BASE_HTML, DEFAULT_DASHBOARD_HTML
+    DEFAULT_BASE_HTML, DEFAULT_DASHBOARD_HTML, DEFAULT_CURRENTLY_PLAYING_HTML, DEFAULT_QUEUE_HTML, \
+    DEFAULT_WORKERS_HTML
 from twitch_ircchat_utils import retrieve_token_info, COMMANDS_FILE
 
 # Configuration and Flask App
 CONFIG_FILE = 'config/config.json'
-QUEUE_FILE = 'queue.json'
 TWITCH_TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
 
 
-def update_queue(track_name, artist_name):
-    with open('queue.json', 'r', encoding='utf-8') as f:
-        queue = json.loads(f.read())
-    while queue and queue[0]['title'] != track_name and queue[0]['author'] != artist_name and len(queue) > 0:
-        queue.pop(0)
-    # print_queue_to_file(queue)
-
-
 class QuartServer:
     def __init__(self, manager):
         self.app = Quart(__name__)
@@ -39,11 +31,13 @@ class QuartServer:
         self.app.add_url_rule('/callback_twitch', view_func=self.callback_twitch)
         self.app.add_url_rule('/page/<page_name>', view_func=self.render_page)
         self.app.add_url_rule('/currently_playing', view_func=self.currently_playing)
+        self.app.add_url_rule('/currently_playing/stream', view_func=self.now_playing_stream)
         self.app.add_url_rule('/favicon.ico', view_func=self.favicon)
         self.app.add_url_rule('/reset', methods=['POST'], view_func=self.reset_config)
         self.app.add_url_rule('/save', view_func=self.save_commands, methods=['POST'])
         self.app.add_url_rule('/save_config', view_func=self.save_config, methods=['POST'])
         self.app.add_url_rule('/stream', view_func=self.stream)
+        self.app.add_url_rule('/stats', view_func=self.stats)
 
     @staticmethod
     async def index():
@@ -59,8 +53,14 @@ class QuartServer:
         elif page_name == 'setup':
             return await render_template_string(DEFAULT_FIRST_TIME_CONFIGURATION_HTML,
                                                 needed_values=self.manager.needed_values)
+        elif page_name == 'queue':
+            return await render_template_string(DEFAULT_QUEUE_HTML, queue=self.manager.song_queue.snapshot(),
+                                                stats=self.manager.song_queue.stats())
+        elif page_name == 'workers':
+            return await render_template_string(DEFAULT_WORKERS_HTML, stats=self.manager.supervisor.stats()
+                                                if self.manager.supervisor is not None else None)
         elif page_name == 'currently_playing':
-            return await render_template_string(self.current_song())
+            return await self.current_song()
         else:
             return "Page not found", 404
 
@@ -70,15 +70,30 @@ class QuartServer:
     def event_stream(self):
         try:
             while not self.manager.shutdown_flag.is_set():
-                message = self.manager.queue.get(block=True)
-                if is_string_valid(message):
-                    yield f"data: {message}\n\n"
+                messages = self.manager.queue.get(block=True)
+                # Chat is pushed in batches, one per websocket frame
+                batch = ''.join(f"data: {message}\n\n" for message in messages if is_string_valid(message))
+                if batch:
+                    yield batch
         except CancelledError:
             pass
 
     async def stream(self):
         return Response(self.event_stream(), mimetype='text/event-stream')
 
+    async def stats(self):
+        return {
+            'analyser': self.manager.analyser.stats(),
+            'prefilter': self.manager.prefilter.stats(),
+            'automod': self.manager.automod.stats(),
+            'spotify': self.manager.spotify.stats(),
+            'queue': self.manager.song_queue.stats(),
+            'helix': self.manager.helix.stats(),
+            'eventsub': self.manager.bot.seen_messages.stats() if self.manager.bot is not None else None,
+            'connections': self.manager.bot.connection_stats() if self.manager.bot is not None else None,
+            'supervisor': self.manager.supervisor.stats() if self.manager.supervisor is not None else None
+        }
+
     async def save_commands(self):
         form_data = await request.form
         process_form(form_data)
@@ -92,44 +107,23 @@ class QuartServer:
     async def setup(self):
         return await render_template_string(DEFAULT_FIRST_TIME_CONFIGURATION_HTML, needed_values=self.manager.needed_values)
 
-    def current_song(self):
-        track = get_current_track(self.manager.configuration['spotify-token']['access_token'])
-        if track:
-            track_name = track['item']['name']
-            artist_name = track['item']['artists'][0]['name']
-
-            album_name = track['item']['album']['name']
-            album_image_url = track['item']['album']['images'][0]['url'] if track['item']['album'][
-                'images'] else 'No image available'
-            track_duration = int(track['item']['duration_ms'])
-            progress = int(track['progress_ms'])
-            if track_duration - progress >= 30000:
-                refresh_rate = 30
-            else:
-                refresh_rate = ((track_duration - progress) / 1000) + 2  # Convert to seconds and adds 2 seconds
-                if path.exists(QUEUE_FILE):
-                    update_queue(track_name, artist_name)
-            html_content = f'''
-                    <!DOCTYPE html>
-                    <html>
-                    <head>
-                        <title>Currently Playing</title>
-                        <meta http-equiv="refresh" content="{refresh_rate}">
-                        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/skeleton/2.0.4/skeleton.min.css">
-                    </head>
-                    <body>
-                        <div>
-                            <h1>Currently Playing</h1>
-                            <p><strong>Track:</strong> {track_name}</p>
-                            <p><strong>Artist:</strong> {artist_name}</p>
-                            <p><strong>Album:</strong> {album_name}</p>
-                            <img src="{album_image_url}" alt="Album art" class="album-art" />
-                        </div>
-                    </body>
-                    </html>
-                    '''
-            return html_content
-        return 'No track is currently playing.'
+    async def current_song(self):
+        # Rendered once, the page then follows the poller through /currently_playing/stream
+        return await render_template_string(DEFAULT_CURRENTLY_PLAYING_HTML, track=self.manager.now_playing.state)
+
+    async def now_playing_stream(self):
+        async def events():
+            queue = self.manager.now_playing.subscribe()
+            try:
+                while not self.manager.shutdown_flag.is_set():
+                    state = await queue.get()
+                    yield f"data: {json.dumps(state)}\n\n"
+            finally:
+                self.manager.now_playing.unsubscribe(queue)
+
+        response = Response(events(), mimetype='text/event-stream')
+        response.timeout = None
+        return response
 
     async def save_config(self):
         form_data = await request.form
@@ -151,13 +145,13 @@ class QuartServer:
             '''
 
     async def currently_playing(self):
-        return await render_template_string(self.current_song())
+        return await self.current_song()
 
     async def callback(self):
-        response = get_token(self.manager.configuration['spotify']['client_id'],
-                             self.manager.configuration['spotify']['redirect_uri'],
-                             request.args['code'],
-                             self.manager.verify)
+        response = await to_thread(get_token, self.manager.configuration['spotify']['client_id'],
+                                   self.manager.configuration['spotify']['redirect_uri'],
+                                   request.args['code'],
+                                   self.manager.verify)
         access_token = response.get('access_token')
         refresh_token = response.get('refresh_token')
         expires_in = response.get('expires_in')
@@ -0,0 +1,76 @@
+from asyncio import Lock, sleep
+from collections import deque
+from time import monotonic
+
+
+class SlidingWindowLimiter:
+    # At most `limit` acquisitions in any `window` seconds, callers wait for their turn in order
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.times = deque()
+        self.lock = Lock()
+        self.waited = 0.0
+
+    async def acquire(self):
+        async with self.lock:
+            now = monotonic()
+            while self.times and self.times[0] <= now - self.window:
+                self.times.popleft()
+            if len(self.times) >= self.limit:
+                delay = self.times[0] + self.window - now
+                self.waited += delay
+                await sleep(delay)
+                self.times.popleft()
+            self.times.append(monotonic())
+
+    def stats(self):
+        now = monotonic()
+        return {
+            'used': sum(1 for t in self.times if t > now - self.window),
+            'limit': self.limit,
+            'waited_s': round(self.waited, 2)
+        }
+
+
+class TokenBucket:
+    # Up to `capacity` sends in a burst, refilled continuously at `rate` tokens per second
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.lock = Lock()
+        self.waited = 0.0
+
+    @classmethod
+    def for_window(cls, limit, window):
+        # A quarter of the limit as burst and the rest refilled over the window: burst plus refill never goes
+        # over `limit` in any `window` seconds, which a bucket of `limit` refilled over `window` would
+        capacity = max(limit // 4, 1)
+        # A limit of 1 has nothing left to refill with, one token every window still keeps to it
+        return cls(capacity, (limit - capacity) / window if limit > capacity else limit / window)
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await sleep(delay)
+                self.refill()
+            self.tokens -= 1
+
+    def stats(self):
+        self.refill()
+        return {
+            'tokens': round(self.tokens, 2),
+            'capacity': self.capacity,
+            'per_s': round(self.rate, 3),
+            'waited_s': round(self.waited, 2)
+        }
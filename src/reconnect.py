@@ -0,0 +1,92 @@
+import random
+from asyncio import CancelledError, wait_for
+from time import monotonic
+
+from websockets import ConnectionClosedOK, WebSocketException
+
+INITIAL_DELAY = 1
+MAX_DELAY = 120
+# A connection that stayed up this long resets the backoff, the next drop is retried right away
+STABLE_AFTER = 60
+
+
+def backoff_delay(attempt):
+    # Full jitter, so several bots dropped by the same outage do not all come back in the same second
+    return random.uniform(0, min(MAX_DELAY, INITIAL_DELAY * 2 ** attempt))
+
+
+class ConnectionSupervisor:
+    def __init__(self, name, connect, manager, shutdown):
+        self.name = name
+        # Runs one connection until it ends, it is called again after every drop
+        self.connect = connect
+        self.manager = manager
+        self.shutdown = shutdown
+        self.attempt = 0
+        self.immediate = False
+        self.disconnected_at = None
+        self.reconnects = 0
+        self.handovers = 0
+        self.last_gap = None
+        self.max_gap = 0.0
+
+    def request_reconnect(self):
+        # The server asked us to move, skip the backoff for the next attempt
+        self.immediate = True
+
+    def connected(self):
+        if self.disconnected_at is not None:
+            self.last_gap = monotonic() - self.disconnected_at
+            self.max_gap = max(self.max_gap, self.last_gap)
+            self.reconnects += 1
+            self.disconnected_at = None
+            self.manager.print.print_to_logs(f"{self.name} reconnected after {self.last_gap:.1f}s "
+                                             f"({self.reconnects} reconnects)", self.manager.print.GREEN)
+
+    def handed_over(self):
+        self.handovers += 1
+        self.manager.print.print_to_logs(f"{self.name} moved to a new session without interruption "
+                                         f"({self.handovers} handovers)", self.manager.print.GREEN)
+
+    async def run(self):
+        while not self.shutdown.is_set():
+            started = monotonic()
+            await self.run_once()
+            if self.shutdown.is_set():
+                break
+            await self.wait_before_retry(started)
+
+    async def run_once(self):
+        # Only socket level failures end up here, message handlers log their own errors
+        try:
+            await self.connect()
+        except CancelledError:
+            raise
+        except ConnectionClosedOK:
+            pass
+        except (OSError, TimeoutError, WebSocketException) as e:
+            self.manager.print.print_to_logs(f"{self.name} connection lost: {e!r}", self.manager.print.RED)
+
+    async def wait_before_retry(self, started):
+        if self.disconnected_at is None:
+            self.disconnected_at = monotonic()
+        if monotonic() - started >= STABLE_AFTER:
+            self.attempt = 0
+        delay = 0 if self.immediate else backoff_delay(self.attempt)
+        self.immediate = False
+        self.attempt += 1
+        self.manager.print.print_to_logs(f"Reconnecting {self.name} in {delay:.1f}s", self.manager.print.YELLOW)
+        try:
+            await wait_for(self.shutdown.wait(), delay)
+        except TimeoutError:
+            pass
+
+    def stats(self):
+        return {
+            'connected': self.disconnected_at is None,
+            'reconnects': self.reconnects,
+            'handovers': self.handovers,
+            'last_gap_s': round(self.last_gap, 2) if self.last_gap is not None else None,
+            'max_gap_s': round(self.max_gap, 2),
+            'down_for_s': round(monotonic() - self.disconnected_at, 2) if self.disconnected_at is not None else 0
+        }
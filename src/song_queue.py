@@ -0,0 +1,180 @@
+import json
+import os
+from collections import Counter, deque
+from time import time
+
+QUEUE_JOURNAL_FILE = 'config/queue.journal'
+# The journal is rewritten once it holds this many times more operations than queued songs
+COMPACTION_RATIO = 4
+MIN_COMPACTION_SIZE = 64
+
+# Reasons a request can be refused
+DUPLICATE = 'duplicate'
+USER_LIMIT = 'user_limit'
+
+
+class SongQueue:
+    def __init__(self, manager, journal_file=QUEUE_JOURNAL_FILE):
+        self.manager = manager
+        self.journal_file = journal_file
+        self.entries = deque()
+        self.by_track = {}
+        self.by_requester = {}
+        # Tracks that passed check() and are waiting for Spotify, so a second request can't slip in meanwhile
+        self.pending = {}
+        self.pending_by_requester = Counter()
+        self.journal_size = 0
+        self.journal = None
+        self.replay()
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    @property
+    def max_per_user(self):
+        return int(self.manager.configuration['queue']['max_per_user'])
+
+    @property
+    def max_batch(self):
+        return int(self.manager.configuration['queue']['max_batch'])
+
+    def check(self, track_id, requester, bypass_limits=False):
+        # A successful check reserves the track until add() or release()
+        if track_id in self.by_track or track_id in self.pending:
+            return DUPLICATE
+        requested = self.by_requester.get(requester, 0) + self.pending_by_requester[requester]
+        if not bypass_limits and 0 < self.max_per_user <= requested:
+            return USER_LIMIT
+        self.pending[track_id] = requester
+        self.pending_by_requester[requester] += 1
+        return None
+
+    def release(self, track_id):
+        requester = self.pending.pop(track_id, None)
+        if requester is None:
+            return
+        self.pending_by_requester[requester] -= 1
+        if not self.pending_by_requester[requester]:
+            del self.pending_by_requester[requester]
+
+    def add(self, track, requester, requester_name):
+        entry = {
+            'id': track['id'],
+            'title': track['name'],
+            'author': ', '.join(a['name'] for a in track['artists']),
+            'duration': track['duration_ms'],
+            'requester': requester,
+            'requested_by': requester_name,
+            'requested_at': int(time())
+        }
+        self.release(track['id'])
+        self.apply_add(entry)
+        self.write('add', entry)
+        return entry
+
+    def remove(self, track_id):
+        if track_id not in self.by_track:
+            return None
+        entry = self.apply_remove(track_id)
+        self.write('remove', {'id': track_id})
+        return entry
+
+    def advance(self, track_id):
+        # The track is now playing: it and everything requested before it leave the queue
+        if track_id not in self.by_track:
+            return []
+        played = self.apply_advance(track_id)
+        self.write('advance', {'id': track_id})
+        return played
+
+    def apply_add(self, entry):
+        self.entries.append(entry)
+        self.by_track[entry['id']] = entry
+        self.by_requester[entry['requester']] = self.by_requester.get(entry['requester'], 0) + 1
+
+    def apply_advance(self, track_id):
+        played = []
+        while self.entries:
+            played.append(self.apply_remove(self.entries[0]['id']))
+            if played[-1]['id'] == track_id:
+                break
+        return played
+
+    def apply_remove(self, track_id):
+        entry = self.by_track.pop(track_id)
+        if self.entries and self.entries[0] is entry:
+            self.entries.popleft()
+        else:
+            self.entries.remove(entry)
+        count = self.by_requester[entry['requester']] - 1
+        if count > 0:
+            self.by_requester[entry['requester']] = count
+        else:
+            del self.by_requester[entry['requester']]
+        return entry
+
+    def apply(self, operation, payload):
+        match operation:
+            case 'add':
+                if payload['id'] not in self.by_track:
+                    self.apply_add(payload)
+            case 'remove':
+                if payload['id'] in self.by_track:
+                    self.apply_remove(payload['id'])
+            case 'advance':
+                if payload['id'] in self.by_track:
+                    self.apply_advance(payload['id'])
+
+    def write(self, operation, payload):
+        self.journal.write(json.dumps({'op': operation, 'data': payload}) + '\n')
+        self.journal.flush()
+        self.journal_size += 1
+        if self.journal_size > max(MIN_COMPACTION_SIZE, COMPACTION_RATIO * len(self.entries)):
+            self.compact()
+
+    def replay(self):
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can leave the last line half written
+                    continue
+                self.apply(record['op'], record['data'])
+                self.journal_size += 1
+        if self.entries:
+            self.manager.print.print_to_logs(f"Restored {len(self.entries)} songs in the request queue",
+                                             self.manager.print.BRIGHT_PURPLE)
+
+    def compact(self):
+        temp_file = f"{self.journal_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps({'op': 'add', 'data': entry}) + '\n')
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(temp_file, self.journal_file)
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        self.journal_size = len(self.entries)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def snapshot(self):
+        return list(self.entries)
+
+    def __contains__(self, track_id):
+        return track_id in self.by_track
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'length': len(self.entries),
+            'requesters': len(self.by_requester),
+            'duration_ms': sum(entry['duration'] for entry in self.entries),
+            'journal_size': self.journal_size
+        }
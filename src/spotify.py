@@ -1,16 +1,51 @@
 import base64
 import hashlib
+import json
+import os
+import re
 import secrets
 import string
+from asyncio import Semaphore, create_task, to_thread
 from time import time
 from urllib.parse import quote
 from webbrowser import open as wbopen
 
 import requests
 
+from cache_utils import TTLCache
+from http_client import AsyncHttpClient, RequestScheduler
+
 SPOTIFY_AUTHORIZATION_URL = 'https://accounts.spotify.com/authorize'
 OAUTH_SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
 SCOPE_SPOTIFY = 'user-read-playback-state user-modify-playback-state'
+SPOTIFY_CACHE_FILE = 'config/spotify_cache.json'
+
+# open.spotify.com/{kind}/{id} links (optionally with an intl-xx segment) and spotify:{kind}:{id} URIs
+SPOTIFY_LINK_PATTERN = re.compile(
+    r'(?:open\.spotify\.com/(?:intl-[\w-]+/)?|spotify:)(track|album|playlist)[/:]([A-Za-z0-9]{22})')
+# Largest page the API serves for each collection
+PAGE_SIZES = {'album': 50, 'playlist': 100}
+# Pages fetched at the same time while expanding an album or playlist
+MAX_CONCURRENT_PAGES = 4
+
+
+# Search cache key, so "Never Gonna  give you up" and "never gonna give you up" share the result
+def normalize_query(query):
+    return ' '.join(query.casefold().split())
+
+
+# Returns (kind, id) for track/album/playlist links and URIs, None for anything else
+def parse_spotify_link(text):
+    match = SPOTIFY_LINK_PATTERN.search(text)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def collection_item_track(item):
+    # Playlist pages wrap every track, and can contain removed tracks, local files and podcast episodes
+    track = item['track'] if 'track' in item else item
+    if not track or track.get('is_local') or track.get('type', 'track') != 'track' or not track.get('id'):
+        return None
+    return track
 
 
 # Parse the song to retrieve the data for the songs
@@ -23,79 +58,152 @@ def parse_song(song):
     }
 
 
-# Getting the player
-def get_player(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get('https://api.spotify.com/v1/me/player', headers=headers, timeout=5)
-    return response.json()
-
-
-# Add a song through query
-def add_song_query(token, query):
-    headers = {'Authorization': f'Bearer {token}'}
-    query = quote(query)
-    search_response = requests.get(f'https://api.spotify.com/v1/search?q={query}&type=track', headers=headers, timeout=5)
-    track_id = search_response.json()['tracks']['items'][0]['id']
-    add_song_id(token, track_id)
-
-
-# Look up song from query
-def query_for_song(token, query):
-    headers = {'Authorization': f'Bearer {token}'}
-    query = quote(query)
-    search_response = requests.get(f'https://api.spotify.com/v1/search?q={query}&type=track', headers=headers, timeout=5)
-    return search_response.json()['tracks']['items'][0]
-
-
-# Get song data from ID
-def get_track_by_id(token, track_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    track_url = f'https://api.spotify.com/v1/tracks/{track_id}'
-    response = requests.get(track_url, headers=headers, timeout=5)
-    return response.json()
-
-
-# Add a song directly through ID
-def add_song_id(token, track_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    uri = quote(f'spotify:track:{track_id}')
-    response = requests.post(f'https://api.spotify.com/v1/me/player/queue?uri={uri}', headers=headers, timeout=5)
-    return response.status_code
-
-
-# Get the queue
-def get_queue(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get('https://api.spotify.com/v1/me/player/queue', headers=headers, timeout=5)
-    return handle_responses(response)
-
-
-# Play/Resume
-def play(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.put('https://api.spotify.com/v1/me/player/play', headers=headers, timeout=5)
-    return response.status_code
-
-
-# Pause
-def pause(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.put('https://api.spotify.com/v1/me/player/pause', headers=headers, timeout=5)
-    return response.status_code
-
-
-# Skip the current song
-def skip(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.post('https://api.spotify.com/v1/me/player/next', headers=headers, timeout=5)
-    return response.status_code
-
-
-# Get currently playing track
-def get_current_track(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get('https://api.spotify.com/v1/me/player/currently-playing', headers=headers, timeout=5)
-    return handle_responses(response)
+class SpotifyClient(AsyncHttpClient):
+    base_url = 'https://api.spotify.com/v1'
+
+    def __init__(self, manager):
+        super().__init__(scheduler=RequestScheduler(on_throttled=self.on_throttled))
+        self.manager = manager
+        cache_config = self.manager.configuration['spotify-cache']
+        self.searches = TTLCache(int(cache_config['max_size']), int(cache_config['search_ttl']))
+        self.tracks = TTLCache(int(cache_config['max_size']), int(cache_config['track_ttl']))
+        if cache_config['persist']:
+            self.load_cache()
+
+    def load_cache(self, file_name=SPOTIFY_CACHE_FILE):
+        if not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            self.manager.print.print_to_logs('Spotify cache file is corrupted, ignoring it', self.manager.print.YELLOW)
+            return
+        self.searches.restore(cache.get('searches', []))
+        self.tracks.restore(cache.get('tracks', []))
+
+    def save_cache(self, file_name=SPOTIFY_CACHE_FILE):
+        if self.manager.configuration['spotify-cache']['persist']:
+            with open(file_name, 'w', encoding='utf-8') as f:
+                json.dump({'searches': self.searches.dump(), 'tracks': self.tracks.dump()}, f)
+
+    def auth_headers(self):
+        return {'Authorization': f"Bearer {self.manager.configuration['spotify-token']['access_token']}"}
+
+    def on_throttled(self, endpoint, retry_after):
+        self.manager.print.print_to_logs(f"Spotify rate limit hit on {endpoint}, waiting {retry_after:.0f}s",
+                                         self.manager.print.YELLOW)
+
+    def stats(self):
+        return {
+            'searches': self.searches.stats(),
+            'tracks': self.tracks.stats(),
+            'requests': self.scheduler.stats()
+        }
+
+    # Getting the player
+    async def get_player(self):
+        response = await self.request('GET', '/me/player')
+        return handle_responses(response)
+
+    # Add a song through query
+    async def add_song_query(self, query):
+        track = await self.query_for_song(query)
+        if track:
+            await self.add_song_id(track['id'])
+        return track
+
+    # Look up song from query
+    async def query_for_song(self, query):
+        key = normalize_query(query)
+        track_id = self.searches.get(key)
+        if track_id is not None:
+            track = self.tracks.get(track_id)
+            if track is not None:
+                return track
+        response = await self.request('GET', '/search', params={'q': query, 'type': 'track'})
+        items = (handle_responses(response) or {}).get('tracks', {}).get('items', [])
+        if not items:
+            return None
+        self.searches.put(key, items[0]['id'])
+        self.tracks.put(items[0]['id'], items[0])
+        return items[0]
+
+    # Get song data from ID
+    async def get_track_by_id(self, track_id):
+        track = self.tracks.get(track_id)
+        if track is not None:
+            return track
+        response = await self.request('GET', f'/tracks/{quote(track_id)}')
+        track = handle_responses(response)
+        if track:
+            self.tracks.put(track_id, track)
+        return track
+
+    async def get_collection_page(self, kind, collection_id, offset, limit):
+        response = await self.request('GET', f'/{kind}s/{quote(collection_id)}/tracks',
+                                      params={'offset': offset, 'limit': limit})
+        return handle_responses(response) or {}
+
+    # Yields the tracks of an album or playlist in order, up to max_tracks
+    async def get_collection_tracks(self, kind, collection_id, max_tracks):
+        limit = PAGE_SIZES[kind]
+        first_page = await self.get_collection_page(kind, collection_id, 0, limit)
+        total = min(first_page.get('total', 0), max_tracks)
+        semaphore = Semaphore(MAX_CONCURRENT_PAGES)
+
+        async def fetch(offset):
+            async with semaphore:
+                return await self.get_collection_page(kind, collection_id, offset, limit)
+
+        # Every remaining page is requested up front, the caller works on the earlier ones while they arrive
+        pages = [create_task(fetch(offset)) for offset in range(limit, total, limit)]
+        count = 0
+        try:
+            for page in [first_page, *pages]:
+                if not isinstance(page, dict):
+                    page = await page
+                for item in page.get('items', []):
+                    track = collection_item_track(item)
+                    if track is None:
+                        continue
+                    yield track
+                    count += 1
+                    if count >= max_tracks:
+                        return
+        finally:
+            for page in pages:
+                page.cancel()
+
+    # Add a song directly through ID
+    async def add_song_id(self, track_id):
+        response = await self.request('POST', '/me/player/queue', params={'uri': f'spotify:track:{track_id}'})
+        return response.status_code
+
+    # Get the queue
+    async def get_queue(self):
+        response = await self.request('GET', '/me/player/queue')
+        return handle_responses(response)
+
+    # Play/Resume
+    async def play(self):
+        response = await self.request('PUT', '/me/player/play')
+        return response.status_code
+
+    # Pause
+    async def pause(self):
+        response = await self.request('PUT', '/me/player/pause')
+        return response.status_code
+
+    # Skip the current song
+    async def skip(self):
+        response = await self.request('POST', '/me/player/next')
+        return response.status_code
+
+    # Get currently playing track
+    async def get_current_track(self):
+        response = await self.request('GET', '/me/player/currently-playing')
+        return handle_responses(response)
 
 
 def handle_responses(response):
@@ -157,8 +265,8 @@ async def start_spotify_oauth_flow(self):
 
 
 async def refresh_spotify_token(self):
-    response = refresh_access_token(self.configuration['spotify']['client_id'],
-                                    self.configuration['spotify-token']['refresh_token'])
+    response = await to_thread(refresh_access_token, self.configuration['spotify']['client_id'],
+                               self.configuration['spotify-token']['refresh_token'])
     if 'access_token' in response:
         access_token = response.get('access_token')
         refresh_token = response.get('refresh_token')
@@ -0,0 +1,337 @@
+import os
+import sys
+from asyncio import CancelledError, Event, create_task, run, sleep, to_thread
+from copy import deepcopy
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic, perf_counter
+
+from ai_helper import ToxicityAnalyser
+from automod import BannedTermMatcher
+from inference_server import READY_TIMEOUT, SLOT_SIZE, RemoteBackend, attach, detach, serve
+from manager_utils import PrintColors, resource_path
+from prefilter import Prefilter
+from reconnect import STABLE_AFTER, backoff_delay
+from twitch import TwitchWebSocketManager, channel_list
+from twitch_helix import HelixClient
+
+MONITOR_INTERVAL = 1
+HEARTBEAT_INTERVAL = 5
+# A process that stops sending heartbeats for this long is considered hung and started again
+HEARTBEAT_TIMEOUT = 30
+# A worker sends its first heartbeat right away, the inference process only once the model is loaded
+WORKER_STARTUP_TIMEOUT = 60
+SERVER_STARTUP_TIMEOUT = READY_TIMEOUT
+STOP_TIMEOUT = 5
+
+
+class ChatRelay:
+    # Stands in for the dashboard queue of Manager, the chat of a worker is shown by the supervisor
+    def __init__(self, connection):
+        self.connection = connection
+        self.lines = 0
+
+    def put(self, lines):
+        self.lines += len(lines)
+        self.connection.send(('chat', lines))
+
+
+class WorkerManager:
+    # The part of Manager a worker needs for its chats, Spotify, the queue and the dashboard stay in the supervisor
+    def __init__(self, worker_id, share, configuration, control):
+        self.startup_time = perf_counter()
+        self.worker_id = worker_id
+        self.share = share
+        self.configuration = configuration
+        self.control = control
+        self.print = PrintColors()
+        self.queue = ChatRelay(control)
+        self.shutdown_flag = Event()
+        self.analyser = ToxicityAnalyser(self)
+        self.analyser.backend_name = RemoteBackend.name
+        self.prefilter = Prefilter(self)
+        self.automod = BannedTermMatcher(self)
+        self.helix = HelixClient(self)
+        self.spotify = None
+        self.now_playing = None
+        self.song_queue = None
+        self.bot = None
+        self.bot_task = None
+        self.loop_lag = 0.0
+
+    resource_path = staticmethod(resource_path)
+
+    async def start_bot(self, channels):
+        if self.bot is not None:
+            await self.bot.close()
+            await self.bot_task
+        # The supervisor keeps the EventSub session, a worker only runs chat connections
+        self.bot = TwitchWebSocketManager(self, channels=channels, eventsub=False, share=self.share)
+        self.bot_task = create_task(self.bot.run())
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'messages': self.queue.lines,
+            'loop_lag_ms': round(self.loop_lag * 1000),
+            'analyser': self.analyser.stats(),
+            'connections': self.bot.connection_stats() if self.bot is not None else None
+        }
+
+    async def main(self, channels):
+        self.analyser.start()
+        await self.start_bot(channels)
+        next_heartbeat = 0
+        while not self.shutdown_flag.is_set():
+            while self.control.poll():
+                message = self.control.recv()
+                match message[0]:
+                    case 'tokens':
+                        self.configuration['twitch-token'] = message[1]
+                        await self.start_bot(channels)
+                    case 'stop':
+                        self.shutdown_flag.set()
+            if self.bot_task.done() and not self.shutdown_flag.is_set():
+                # Without its chats the worker has nothing to report, exiting lets the supervisor start it again
+                error = None if self.bot_task.cancelled() else self.bot_task.exception()
+                self.print.print_to_logs(f"Worker {self.worker_id} bot stopped: {error!r}", self.print.RED)
+                await self.analyser.stop()
+                self.helix.close()
+                return 1
+            if monotonic() >= next_heartbeat:
+                self.control.send(('stats', self.stats()))
+                next_heartbeat = monotonic() + HEARTBEAT_INTERVAL
+            start = monotonic()
+            await sleep(MONITOR_INTERVAL)
+            # How late the loop woke up, a busy worker falls behind on its chats long before it crashes
+            self.loop_lag = max(monotonic() - start - MONITOR_INTERVAL, 0)
+        await self.bot.close()
+        await self.analyser.stop()
+        self.helix.close()
+        return 0
+
+
+def run_worker(worker_id, channels, share, configuration, slot_name, slot_connection, control):
+    attach(slot_name, slot_connection)
+    try:
+        code = run(WorkerManager(worker_id, share, configuration, control).main(channels))
+    except KeyboardInterrupt:
+        code = 0
+    sys.exit(code)
+
+
+class ChildProcess:
+    # One child process and its control pipe, started again with a backoff when it exits or hangs
+    def __init__(self, supervisor, name, target, arguments, startup_timeout=WORKER_STARTUP_TIMEOUT):
+        self.supervisor = supervisor
+        self.manager = supervisor.manager
+        self.name = name
+        self.target = target
+        # Called on every start, a restarted worker gets the tokens that are current at that point
+        self.arguments = arguments
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.connection = None
+        self.started_at = None
+        self.last_seen = None
+        self.restart_at = None
+        self.ready = False
+        self.restarts = 0
+        self.failures = 0
+        self.status = {}
+        self.channels = []
+        self.previous = None
+        self.rate = 0.0
+
+    def start(self):
+        self.connection, child = self.supervisor.context.Pipe()
+        self.process = self.supervisor.context.Process(target=self.target, args=(*self.arguments(), child),
+                                                       name=self.name, daemon=True)
+        self.process.start()
+        child.close()
+        self.started_at = self.last_seen = monotonic()
+        self.restart_at = None
+        self.ready = False
+
+    def receive(self):
+        try:
+            while self.connection.poll():
+                message = self.connection.recv()
+                self.last_seen = monotonic()
+                self.ready = True
+                yield message
+        except (EOFError, OSError):
+            return
+
+    def update(self, status):
+        now = monotonic()
+        # Messages per minute between two heartbeats, the load figure shown on the dashboard
+        if 'messages' in status and self.previous is not None and now > self.previous[0]:
+            self.rate = (status['messages'] - self.previous[1]) * 60 / (now - self.previous[0])
+        if 'messages' in status:
+            self.previous = (now, status['messages'])
+        self.status = status
+
+    async def check(self):
+        now = monotonic()
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.restarts += 1
+                self.manager.print.print_to_logs(f"Starting {self.name} again ({self.restarts} restarts)",
+                                                 self.manager.print.YELLOW)
+                self.start()
+            return
+        if self.process.is_alive():
+            # Until its first message the process gets the startup deadline, from then on the heartbeat one
+            if now - self.last_seen < (HEARTBEAT_TIMEOUT if self.ready else self.startup_timeout):
+                return
+            self.manager.print.print_to_logs(f"{self.name} sent no {'heartbeat' if self.ready else 'first message'} "
+                                             f"for {now - self.last_seen:.0f}s, terminating it",
+                                             self.manager.print.RED)
+            self.process.terminate()
+            # Joining can take up to STOP_TIMEOUT, the chats of the supervisor keep running meanwhile
+            await to_thread(self.process.join, STOP_TIMEOUT)
+        else:
+            self.manager.print.print_to_logs(f"{self.name} exited with code {self.process.exitcode}",
+                                             self.manager.print.RED)
+        self.connection.close()
+        self.failures = 0 if now - self.started_at >= STABLE_AFTER else self.failures + 1
+        self.restart_at = now + backoff_delay(self.failures)
+        self.previous = None
+        self.rate = 0.0
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.connection.send(('stop',))
+            except OSError:
+                pass
+            self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(STOP_TIMEOUT)
+        self.connection.close()
+
+    def stats(self):
+        now = monotonic()
+        alive = self.process is not None and self.process.is_alive()
+        return {
+            'name': self.name,
+            'alive': alive,
+            'healthy': alive and self.ready and now - self.last_seen < HEARTBEAT_TIMEOUT,
+            'uptime_s': round(now - self.started_at) if alive else 0,
+            'last_seen_s': round(now - self.last_seen, 1) if self.last_seen is not None else None,
+            'restarts': self.restarts,
+            'messages_per_min': round(self.rate, 1),
+            'status': self.status
+        }
+
+
+class ProcessSupervisor:
+    # Spreads the extra channels over worker processes, all of them score chat through one inference process
+    def __init__(self, manager):
+        self.manager = manager
+        self.context = get_context('spawn')
+        self.memories = []
+        self.server = None
+        self.workers = []
+        self.channels = []
+        self.tokens = None
+
+    @property
+    def worker_count(self):
+        return max(int(self.manager.configuration['supervisor']['workers']), 0)
+
+    @property
+    def limit_share(self):
+        # The supervisor and every worker get the same part of the account's JOIN and chat limits
+        return 1 / (len(self.channels) + 1)
+
+    def local_channels(self):
+        # The supervisor keeps the primary channel, its commands drive Spotify and the song queue
+        return [self.manager.configuration['twitch']['channel'].lower()]
+
+    def assign_channels(self):
+        primary = self.manager.configuration['twitch']['channel'].lower()
+        extra = [channel for channel in dict.fromkeys(channel_list(self.manager.configuration['irc']['channels']))
+                 if channel != primary]
+        groups = [extra[idx::self.worker_count] for idx in range(self.worker_count)]
+        return [group for group in groups if group]
+
+    def create_slot(self):
+        memory = SharedMemory(create=True, size=SLOT_SIZE)
+        self.memories.append(memory)
+        server_end, client_end = self.context.Pipe()
+        return memory.name, server_end, client_end
+
+    def start(self):
+        self.channels = self.assign_channels()
+        self.tokens = dict(self.manager.configuration['twitch-token'])
+        slots = [self.create_slot() for _ in range(len(self.channels) + 1)]
+        backend_name = self.manager.configuration['ai']['backend']
+        server_slots = [(name, server_end) for name, server_end, _ in slots]
+        self.server = ChildProcess(self, 'Inference process', serve, lambda: (backend_name, server_slots),
+                                   startup_timeout=SERVER_STARTUP_TIMEOUT)
+        self.server.start()
+        # The supervisor scores its own chat through the shared process too, the model is never loaded twice
+        name, _, client_end = slots[0]
+        attach(name, client_end)
+        self.manager.analyser.backend_name = RemoteBackend.name
+        for worker_id, (channels, (name, _, client_end)) in enumerate(zip(self.channels, slots[1:])):
+            worker = ChildProcess(self, f"Worker {worker_id}", run_worker, self.worker_arguments(
+                worker_id, channels, name, client_end))
+            worker.channels = channels
+            worker.start()
+            self.workers.append(worker)
+        self.manager.print.print_to_logs(
+            f"Supervisor started {len(self.workers)} workers for {sum(map(len, self.channels))} channels",
+            self.manager.print.GREEN)
+
+    def worker_arguments(self, worker_id, channels, slot_name, slot_connection):
+        return lambda: (worker_id, channels, self.limit_share, deepcopy(self.manager.configuration), slot_name,
+                        slot_connection)
+
+    def handle_message(self, child, message):
+        match message[0]:
+            case 'chat':
+                self.manager.queue.put(message[1])
+            case 'stats' | 'ready':
+                child.update(message[1])
+
+    def update_tokens(self):
+        tokens = dict(self.manager.configuration['twitch-token'])
+        if tokens == self.tokens:
+            return
+        self.tokens = tokens
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.connection.send(('tokens', tokens))
+
+    async def run(self):
+        try:
+            while not self.manager.shutdown_flag.is_set():
+                for child in (self.server, *self.workers):
+                    for message in child.receive():
+                        self.handle_message(child, message)
+                    await child.check()
+                await sleep(MONITOR_INTERVAL)
+        except CancelledError:
+            pass
+
+    def stop(self):
+        for child in (*self.workers, self.server):
+            if child is not None:
+                child.stop()
+        detach()
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+    def stats(self):
+        return {
+            'inference': self.server.stats() if self.server is not None else None,
+            'workers': [{**worker.stats(), 'channels': worker.channels} for worker in self.workers]
+        }
@@ -28,6 +28,8 @@ DEFAULT_BASE_HTML = """
             <li><a href="#home" class="navButton">Home</a></li>
             <li><a href="#commands" class="navButton">Commands</a></li>
             <li><a href="#currently_playing" class="navButton">Currently Playing</a></li>
+            <li><a href="#queue" class="navButton">Queue</a></li>
+            <li><a href="#workers" class="navButton">Workers</a></li>
             <li><a href="#dashboard" class="navButton">Dashboard</a></li>
         </ul>
     </nav>
@@ -107,7 +109,9 @@ DEFAULT_COMMANDS_HTML = """
                                 <label for="simple_{{ command_name }}_timeout" style="margin-right: 10px; margin-bottom: 0;">Timeout (seconds):</label>
                                 <input class="u-full-width" type="number" name="simple_{{ command_name }}_timeout" min="0" max="3600" value="{{ command_data.get('timeout', 0) }}" style="width: 70px; margin-right: 20px;">
                                 <label for="simple_{{ command_name }}_min-messages" style="margin-right: 10px; margin-bottom: 0;">Min Messages:</label>
-                                <input class="u-full-width" type="number" name="simple_{{ command_name }}_min-messages" min="0" max="99" value="{{ command_data.get('min-messages', 0) }}" style="width: 50px;">
+                                <input class="u-full-width" type="number" name="simple_{{ command_name }}_min-messages" min="0" max="99" value="{{ command_data.get('min-messages', 0) }}" style="width: 50px; margin-right: 20px;">
+                                <label for="simple_{{ command_name }}_user-timeout" style="margin-right: 10px; margin-bottom: 0;">Per User (seconds):</label>
+                                <input class="u-full-width" type="number" name="simple_{{ command_name }}_user-timeout" min="0" max="3600" value="{{ command_data.get('user-timeout', 0) }}" style="width: 70px;">
                             </div>
                         </div>
                     {% endfor %}
@@ -158,7 +162,9 @@ DEFAULT_COMMANDS_HTML = """
                     <label for="simple_${newCommandName.toLowerCase()}_timeout" style="margin-right: 10px; margin-bottom: 0;">Timeout (seconds):</label>
                     <input class="u-full-width" type="number" name="simple_${newCommandName.toLowerCase()}_timeout" min="0" max="3600" value="0" style="width: 70px; margin-right: 20px;">
                     <label for="simple_${newCommandName.toLowerCase()}_min-messages" style="margin-right: 10px; margin-bottom: 0;">Min Messages:</label>
-                    <input class="u-full-width" type="number" name="simple_${newCommandName.toLowerCase()}_min-messages" min="0" max="99" value="0" style="width: 50px;">
+                    <input class="u-full-width" type="number" name="simple_${newCommandName.toLowerCase()}_min-messages" min="0" max="99" value="0" style="width: 50px; margin-right: 20px;">
+                    <label for="simple_${newCommandName.toLowerCase()}_user-timeout" style="margin-right: 10px; margin-bottom: 0;">Per User (seconds):</label>
+                    <input class="u-full-width" type="number" name="simple_${newCommandName.toLowerCase()}_user-timeout" min="0" max="3600" value="0" style="width: 70px;">
                 </div>
             </div>
         `;
@@ -179,6 +185,17 @@ DEFAULT_COMMANDS_HTML = """
 
 
 DEFAULT_DASHBOARD_HTML = """
+<div class="row" id="analysis-stats">
+    <h4>Chat Analysis</h4>
+    <p>
+        <strong>Mode:</strong> <span id="analysis-mode">-</span> |
+        <strong>Queue:</strong> <span id="analysis-queue">-</span> |
+        <strong>Latency:</strong> <span id="analysis-latency">-</span> ms |
+        <strong>Scored:</strong> <span id="analysis-scored">-</span> |
+        <strong>Shed:</strong> <span id="analysis-shed">-</span> |
+        <strong>Cache hit rate:</strong> <span id="analysis-cache">-</span>
+    </p>
+</div>
 <ul id="messages">
     <!-- Messages will be appended here -->
 </ul>
@@ -193,5 +210,154 @@ DEFAULT_DASHBOARD_HTML = """
             list.appendChild(listItem);
         };
     });
+
+    (function refreshAnalysisStats() {
+        if (!document.getElementById('analysis-stats')) {
+            return;
+        }
+        $.getJSON('/stats', function(stats) {
+            var analyser = stats.analyser;
+            $('#analysis-mode').text(analyser.mode);
+            $('#analysis-queue').text(analyser.queue_depth);
+            $('#analysis-latency').text(analyser.latency_ms);
+            $('#analysis-scored').text(analyser.scored);
+            $('#analysis-shed').text(analyser.shed);
+            $('#analysis-cache').text((analyser.cache.hit_rate * 100).toFixed(1) + '%');
+        }).always(function() {
+            setTimeout(refreshAnalysisStats, 2000);
+        });
+    })();
 </script>
 """
+
+
+DEFAULT_CURRENTLY_PLAYING_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Currently Playing</title>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/skeleton/2.0.4/skeleton.min.css">
+</head>
+<body>
+    <div id="now-playing">
+        <p id="now-playing-empty" {% if track %}style="display: none;"{% endif %}>No track is currently playing.</p>
+        <div id="now-playing-track" {% if not track %}style="display: none;"{% endif %}>
+            <h1>Currently Playing</h1>
+            <p><strong>Track:</strong> <span id="now-playing-name">{{ track.track_name if track }}</span></p>
+            <p><strong>Artist:</strong> <span id="now-playing-artist">{{ track.artist_name if track }}</span></p>
+            <p><strong>Album:</strong> <span id="now-playing-album">{{ track.album_name if track }}</span></p>
+            <img id="now-playing-art" src="{{ track.album_image_url if track and track.album_image_url }}" alt="Album art" class="album-art" />
+        </div>
+    </div>
+    <script>
+        (function() {
+            // The dashboard loads this page more than once, only one stream must stay open
+            if (window.nowPlayingSource) {
+                window.nowPlayingSource.close();
+            }
+            var source = new EventSource('/currently_playing/stream');
+            window.nowPlayingSource = source;
+            source.onmessage = function(event) {
+                if (!document.getElementById('now-playing')) {
+                    source.close();
+                    return;
+                }
+                var track = JSON.parse(event.data);
+                document.getElementById('now-playing-empty').style.display = track ? 'none' : '';
+                document.getElementById('now-playing-track').style.display = track ? '' : 'none';
+                if (track) {
+                    document.getElementById('now-playing-name').textContent = track.track_name;
+                    document.getElementById('now-playing-artist').textContent = track.artist_name;
+                    document.getElementById('now-playing-album').textContent = track.album_name;
+                    document.getElementById('now-playing-art').src = track.album_image_url || '';
+                }
+            };
+        })();
+    </script>
+</body>
+</html>
+"""
+
+
+DEFAULT_QUEUE_HTML = """
+<div class="container">
+    <h2>Queue</h2>
+    <p>{{ stats['length'] }} songs from {{ stats['requesters'] }} viewers, {{ (stats['duration_ms'] // 60000) }} minutes</p>
+    {% if queue %}
+        <table class="u-full-width">
+            <thead>
+                <tr>
+                    <th>#</th>
+                    <th>Title</th>
+                    <th>Artist</th>
+                    <th>Requested by</th>
+                    <th>Duration</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for song in queue %}
+                    <tr>
+                        <td>{{ loop.index }}</td>
+                        <td>{{ song['title'] }}</td>
+                        <td>{{ song['author'] }}</td>
+                        <td>{{ song['requested_by'] }}</td>
+                        <td>{{ song['duration'] // 60000 }}:{{ '%02d' % (song['duration'] // 1000 % 60) }}</td>
+                    </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    {% else %}
+        <p>No songs requested.</p>
+    {% endif %}
+</div>
+"""
+
+
+DEFAULT_WORKERS_HTML = """
+<div class="container">
+    <h2>Workers</h2>
+    {% if stats %}
+        {% set inference = stats['inference'] %}
+        <h4>Inference process</h4>
+        <p>
+            {{ 'Healthy' if inference['healthy'] else ('Loading' if inference['alive'] else 'Down') }},
+            {{ inference['restarts'] }} restarts, last heartbeat {{ inference['last_seen_s'] }}s ago
+            {% if inference['status'] %}
+                <br>{{ inference['status']['backend'] }}: {{ inference['status']['texts'] }} messages in
+                {{ inference['status']['batches'] }} batches ({{ inference['status']['avg_batch'] }} per batch),
+                busy {{ (inference['status']['busy_ratio'] * 100) | round(1) }}% of the time
+            {% endif %}
+        </p>
+        <table class="u-full-width">
+            <thead>
+                <tr>
+                    <th>Worker</th>
+                    <th>Status</th>
+                    <th>Channels</th>
+                    <th>Messages/min</th>
+                    <th>Loop lag</th>
+                    <th>Analysis queue</th>
+                    <th>Uptime</th>
+                    <th>Restarts</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for worker in stats['workers'] %}
+                    <tr>
+                        <td>{{ worker['name'] }}</td>
+                        <td>{{ 'Healthy' if worker['healthy'] else ('Starting' if worker['alive'] else 'Down') }}</td>
+                        <td>{{ ', '.join(worker['channels']) }}</td>
+                        <td>{{ worker['messages_per_min'] }}</td>
+                        <td>{{ worker['status'].get('loop_lag_ms', '-') }} ms</td>
+                        <td>{{ worker['status']['analyser']['queue_depth'] if worker['status'] else '-' }}</td>
+                        <td>{{ worker['uptime_s'] // 60 }} min</td>
+                        <td>{{ worker['restarts'] }}</td>
+                    </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    {% else %}
+        <p>Supervisor mode is off, set supervisor/workers above 0 to spread the channels over worker processes.</p>
+    {% endif %}
+</div>
+"""
@@ -1,91 +1,243 @@
 import json
 import ssl
-from asyncio import Event, gather
+from asyncio import Event, create_task, gather, wait_for
+from os import path
 
 import websockets
-from websockets import ConnectionClosedOK, ConnectionClosedError
+from websockets import ConnectionClosed
 
+from cache_utils import DedupWindow
+from chat_queue import LIMIT_WINDOW, USER_LIMIT, OutboundQueue
+from eventsub_conduit import EventSubConduit
 from manager_utils import PrintColors
-from src.twitch_eventsub_utils import get_user_info, subscribe_to_follow, handle_eventsub_messages
+from rate_limit import SlidingWindowLimiter, TokenBucket
+from reconnect import ConnectionSupervisor, backoff_delay
+from twitch_eventsub_utils import EVENTSUB_URL, reconcile_subscriptions, handle_eventsub_messages, open_session, \
+    drain_session, keepalive_timeout
 from twitch_commands import TwitchCommands
-from twitch_ircchat_utils import handle_irc_message, authenticate, join_channel
+from twitch_ircchat_utils import COMMANDS_FILE, handle_irc_frame, authenticate, join_channels, load_commands
 
-EVENTSUB_URL = 'wss://eventsub.wss.twitch.tv/ws'
 CHAT_URL = 'wss://irc-ws.chat.twitch.tv:443'
+# Twitch can redeliver a message for up to 10 minutes, the window holds at most this many ids
+DEDUP_WINDOW = 10 * 60
+DEDUP_SIZE = 4096
+# Twitch allows 20 JOINs every 10 seconds per account, shared by all the connections
+JOIN_LIMIT = 20
+JOIN_WINDOW = 10
+
+
+def channel_list(value):
+    return [channel.strip().lstrip('#').lower() for channel in value.split(',') if channel.strip()]
+
+
+class TwitchChannel:
+    # Everything that belongs to one chat: its command tables, their cooldowns and the connection it was joined on
+    def __init__(self, bot, channel, primary=False):
+        self.bot = bot
+        self.manager = bot.manager
+        self.channel = channel
+        self.primary = primary
+        self.commands_file = COMMANDS_FILE if primary else path.join(path.dirname(COMMANDS_FILE),
+                                                                     f'commands_{channel}.json')
+        self.simple_commands = {}
+        self.complex_commands = {}
+        self.twitch_commands = TwitchCommands(self)
+        self.connection = None
+        self.outbound = OutboundQueue(self)
+        load_commands(self)
+
+    async def send_chat(self, line):
+        return await self.connection.send_chat(line)
+
+
+class IrcConnection:
+    def __init__(self, bot, index, channels):
+        self.bot = bot
+        self.manager = bot.manager
+        self.index = index
+        self.channels = channels
+        for channel in channels:
+            channel.connection = self
+        self.websocket = None
+        self.ready = Event()
+        self.supervisor = ConnectionSupervisor(f"Chat {index}", self.connection, bot.manager, bot.shutdown)
+
+    async def connection(self):
+        async with websockets.connect(CHAT_URL, ssl=self.bot.ssl_context) as websocket:
+            self.websocket = websocket
+            await authenticate(self, self.websocket)
+            await join_channels(self, self.websocket)
+            self.supervisor.connected()
+            self.ready.set()
+            try:
+                while not self.bot.shutdown.is_set():
+                    frame = await self.websocket.recv()
+                    # print(f"Chat Message: {frame}")
+                    await handle_irc_frame(self, frame)
+            finally:
+                self.ready.clear()
+
+    async def reconnect(self):
+        # Twitch is about to drop the connection, reconnect right away instead of waiting for the backoff
+        self.supervisor.request_reconnect()
+        self.ready.clear()
+        await self.websocket.close()
+
+    async def send_chat(self, line):
+        # False when the connection dropped, the channel's queue keeps the line for after the reconnect
+        if not self.ready.is_set():
+            return False
+        try:
+            await self.websocket.send(line)
+            return True
+        except ConnectionClosed:
+            return False
+
+    async def close(self):
+        if self.websocket:
+            await self.websocket.close()
+
+    def stats(self):
+        return {
+            'channels': [channel.channel for channel in self.channels],
+            **self.supervisor.stats()
+        }
 
 
 class TwitchWebSocketManager:
-    def __init__(self, manager):
+    def __init__(self, manager, channels=None, eventsub=True, share=1):
         self.manager = manager
-        self.channel = self.manager.configuration['twitch']['channel']
-        self.manager.print.print_to_logs(f"Connecting to {self.channel}", self.manager.print.GREEN)
-        self.complex_commands = {}
-        self.simple_commands = {}
-        self.chat_websocket = None
+        # The configured channel is the primary one: the dashboard commands, Spotify and the EventSub session are its
+        self.channel = self.manager.configuration['twitch']['channel'].lower()
+        self.configured_channels = list(dict.fromkeys([self.channel,
+                                                       *channel_list(self.manager.configuration['irc']['channels'])]))
+        # A supervisor worker only joins its share of the channels and leaves EventSub to the supervisor
+        names = channels if channels is not None else self.configured_channels
+        self.eventsub = eventsub
+        self.manager.print.print_to_logs(f"Connecting to {', '.join(names)}", self.manager.print.GREEN)
         self.eventsub_websocket = None
         self.shutdown = Event()
-        self.twitch_commands = TwitchCommands(self)
         self.ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
         self.ssl_context.load_cert_chain(certfile=self.manager.resource_path('localhost.ecc.crt'),
                                     keyfile=self.manager.resource_path('localhost.ecc.key'))
-        self.user = get_user_info(self)
-        self.last_message_id = None
+        # Filled in by setup(), the Helix lookup is not done while constructing the bot
+        self.user = None
+        self.seen_messages = DedupWindow(DEDUP_SIZE, DEDUP_WINDOW)
+        self.session_id = None
+        # Set by run() when eventsub/conduit_shards is above 0, it replaces the single EventSub session
+        self.conduit = None
+        self.eventsub_supervisor = ConnectionSupervisor('EventSub', self.eventsub_connection, manager, self.shutdown)
+        # The account limits are split between the processes of the supervisor, `share` is this one's part
+        # Chat sends of every channel where the bot is not a moderator count against this one limit
+        self.chat_bucket = TokenBucket.for_window(max(int(USER_LIMIT * share), 1), LIMIT_WINDOW)
+        self.channels = {name: TwitchChannel(self, name, primary=name == self.channel) for name in names}
+        self.join_limiter = SlidingWindowLimiter(max(int(JOIN_LIMIT * share), 1), JOIN_WINDOW)
+        per_connection = max(1, int(self.manager.configuration['irc']['channels_per_connection']))
+        channels = list(self.channels.values())
+        self.connections = [IrcConnection(self, idx, channels[start:start + per_connection])
+                            for idx, start in enumerate(range(0, len(channels), per_connection))]
 
     @property
-    def headers(self):
-        return {
-            'Authorization': f'Bearer {self.manager.configuration['twitch-token']['access_token']}',
-            'Client-Id': self.manager.configuration['twitch']['client_id'],
-            'Content-Type': 'application/json'
-        }
+    def nick(self):
+        # The account the token belongs to, which is the broadcaster for a single channel bot
+        return self.user['login'] if self.user is not None else self.channel
 
-    async def eventsub_connection(self):
-        async with websockets.connect(EVENTSUB_URL, ssl=self.ssl_context) as websocket:
-            self.eventsub_websocket = websocket
-            message = await self.eventsub_websocket.recv()
-            message = json.loads(message)
-            self.last_message_id = message['metadata']['message_id']
-            subscribe_to_follow(self, message['payload']['session']['id'])
+    @property
+    def primary(self):
+        return self.channels[self.channel]
+
+    async def setup(self):
+        self.user = await self.manager.helix.get_authenticated_user()
+        if self.user is None:
+            self.manager.print.print_to_logs('Could not retrieve the Twitch user', self.manager.print.RED)
+
+    async def wait_for_user(self):
+        # The EventSub conditions need the bot's user id, chat runs meanwhile
+        attempt = 0
+        while self.user is None and not self.shutdown.is_set():
+            delay = backoff_delay(attempt)
+            attempt += 1
+            self.manager.print.print_to_logs(f"EventSub waits for the Twitch user, retrying in {delay:.1f}s",
+                                             self.manager.print.YELLOW)
             try:
-                while not self.shutdown.is_set():
-                    message = await self.eventsub_websocket.recv()
-                    message = json.loads(message)
-                    if self.last_message_id != message['metadata']['message_id']:
-                        self.last_message_id = message['metadata']['message_id']
-                        if message['metadata']['message_type'] != 'session_keepalive':
-                            # print(f"Eventsub Message: {message}")
-                            handle_eventsub_messages(self, message)
-            except ConnectionClosedOK:
+                await wait_for(self.shutdown.wait(), delay)
+            except TimeoutError:
                 pass
-            except ConnectionClosedError as e:
-                print(f"Error: {e}")
-
-    async def chat_connection(self):
-        async with websockets.connect(CHAT_URL, ssl=self.ssl_context) as websocket:
-            self.chat_websocket = websocket
-            await authenticate(self, self.chat_websocket)
-            await join_channel(self, self.chat_websocket)
+            self.user = await self.manager.helix.get_authenticated_user()
+        return self.user is not None
+
+    async def run_eventsub(self):
+        if not await self.wait_for_user():
+            return
+        await (self.conduit.run() if self.conduit is not None else self.eventsub_supervisor.run())
+
+    def handle_eventsub_message(self, message):
+        if message['metadata']['message_type'] == 'session_keepalive':
+            return
+        if not self.seen_messages.seen(message['metadata']['message_id']):
+            # print(f"Eventsub Message: {message}")
             try:
-                while not self.shutdown.is_set():
-                    message = await self.chat_websocket.recv()
-                    # print(f"Chat Message: {message}")
-                    await handle_irc_message(self, message)
-            except ConnectionClosedOK:
-                pass
-            except ConnectionClosedError as e:
-                print(f"Error: {e}")
+                handle_eventsub_messages(self, message)
+            except Exception as e:
+                # A handler tripping on an unexpected payload must not take the session down with it
+                self.manager.print.print_to_logs(
+                    f"Error while handling {message['metadata'].get('subscription_type', 'EventSub')}: {e!r}",
+                    self.manager.print.RED)
+
+    async def eventsub_connection(self):
+        self.eventsub_websocket, session = await open_session(self, EVENTSUB_URL)
+        self.session_id = session['id']
+        timeout = keepalive_timeout(session)
+        self.eventsub_supervisor.connected()
+        try:
+            await reconcile_subscriptions(self, self.session_id)
+            while not self.shutdown.is_set():
+                message = json.loads(await wait_for(self.eventsub_websocket.recv(), timeout))
+                if message['metadata']['message_type'] == 'session_reconnect':
+                    # The new session is opened before the old one is closed, subscriptions move with it
+                    old_websocket = self.eventsub_websocket
+                    self.eventsub_websocket, session = await open_session(
+                        self, message['payload']['session']['reconnect_url'])
+                    self.session_id = session['id']
+                    timeout = keepalive_timeout(session)
+                    self.eventsub_supervisor.handed_over()
+                    await drain_session(self, old_websocket)
+                else:
+                    self.handle_eventsub_message(message)
+        finally:
+            await self.eventsub_websocket.close()
+
+    def connection_stats(self):
+        return {
+            'eventsub': self.conduit.stats() if self.conduit is not None else self.eventsub_supervisor.stats(),
+            'chat': [connection.stats() for connection in self.connections],
+            'outbound': {name: channel.outbound.stats() for name, channel in self.channels.items()},
+            'cooldowns': {name: channel.twitch_commands.cooldowns.stats() for name, channel in self.channels.items()},
+            'joins': self.join_limiter.stats()
+        }
 
     async def run(self):
-        # Run both connections in parallel
-        await gather(
-            self.eventsub_connection(),
-            self.chat_connection()
-        )
-        # await self.chat_connection()
+        await self.setup()
+        shards = int(self.manager.configuration['eventsub']['conduit_shards'])
+        if self.eventsub and shards > 0:
+            self.conduit = EventSubConduit(self, shards)
+        # Run all the connections in parallel, each one is restarted by its supervisor when it drops
+        tasks = [connection.supervisor.run() for connection in self.connections]
+        if self.eventsub:
+            tasks.append(self.run_eventsub())
+        senders = [create_task(channel.outbound.run()) for channel in self.channels.values()]
+        try:
+            await gather(*tasks)
+        finally:
+            for sender in senders:
+                sender.cancel()
 
     async def close(self):
-        if self.chat_websocket:
-            await self.chat_websocket.close()
+        self.shutdown.set()
+        for connection in self.connections:
+            await connection.close()
         if self.eventsub_websocket:
             await self.eventsub_websocket.close()
+        if self.conduit:
+            await self.conduit.close()
         self.manager.print.print_to_logs('Twitch Bot Shut Down!', PrintColors.YELLOW)
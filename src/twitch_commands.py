@@ -1,68 +1,162 @@
 import re
+from asyncio import create_task
 
-import spotify
+import song_queue
+from chat_queue import CHATTER, REPLY
+from cooldowns import Cooldowns
+from spotify import parse_song, parse_spotify_link
 
-FUNCTION_LIST = ['song', 'play', 'pause', 'skip', 'sbagliato', 'sr']
+FUNCTION_LIST = ['song', 'play', 'pause', 'skip', 'sbagliato', 'sr', 'srbatch']
+# Level given to a complex command when it is first added to commands.json, 'ANY' if not listed
+FUNCTION_LEVELS = {'srbatch': 'MOD'}
+# Commands that act on the Spotify account, only enabled by default on the primary channel
+SPOTIFY_FUNCTIONS = {'song', 'play', 'pause', 'skip', 'sr', 'srbatch'}
+COLLECTION_NAMES = {'album': "dall'album", 'playlist': 'dalla playlist'}
+REFUSED = 'refused'
 URL_PATTERN = r'\b(?:https?|ftp):\/\/[\w\-]+(\.[\w\-]+)+[/\w\-?=&#%]*\b'
 
 
 class TwitchCommands:
     def __init__(self, twitch_manager):
         self.twitch_manager = twitch_manager
-        self.command_timeout = {}
+        self.cooldowns = Cooldowns()
+        # Album and playlist requests still being queued, referenced so they are not garbage collected
+        self.background_tasks = set()
 
-    async def song(self):
-        response = spotify.get_queue(self.twitch_manager.manager.configuration['spotify-token']['access_token'])
-        currently_playing = spotify.parse_song(response['currently_playing'])
-        await send_message(self.twitch_manager, currently_playing['name'])
+    @property
+    def spotify(self):
+        return self.twitch_manager.manager.spotify
 
-    async def play(self):
-        spotify.play(self.twitch_manager.manager.configuration['spotify-token']['access_token'])
+    @property
+    def song_queue(self):
+        return self.twitch_manager.manager.song_queue
+
+    async def song(self, message):
+        # The poller already knows the track, the API is only asked when it has nothing yet
+        state = self.twitch_manager.manager.now_playing.state
+        if state is not None:
+            await send_message(self.twitch_manager, state['track_name'])
+            return
+        response = await self.spotify.get_current_track()
+        if response and response.get('item'):
+            await send_message(self.twitch_manager, parse_song(response['item'])['name'])
+
+    async def play(self, message):
+        await self.spotify.play()
+        self.twitch_manager.manager.now_playing.refresh()
         self.twitch_manager.manager.print.print_to_logs('Resumed!', self.twitch_manager.manager.print.YELLOW)
         await send_message(self.twitch_manager, 'Resumed!')
 
-    async def pause(self):
-        spotify.pause(self.twitch_manager.manager.configuration['spotify-token']['access_token'])
+    async def pause(self, message):
+        await self.spotify.pause()
+        self.twitch_manager.manager.now_playing.refresh()
         self.twitch_manager.manager.print.print_to_logs('Paused!', self.twitch_manager.manager.print.YELLOW)
         await send_message(self.twitch_manager, 'Paused!')
 
-    async def skip(self):
-        spotify.skip(self.twitch_manager.manager.configuration['spotify-token']['access_token'])
+    async def skip(self, message):
+        await self.spotify.skip()
+        self.twitch_manager.manager.now_playing.refresh()
         self.twitch_manager.manager.print.print_to_logs('Skipped!', self.twitch_manager.manager.print.YELLOW)
         await send_message(self.twitch_manager, 'Skipped!')
 
-    async def sbagliato(self):
-        await send_message(self.twitch_manager, 'Oh No')
-
-    async def sr(self, requested_song):
-        if re.search(URL_PATTERN, requested_song):
-            requested_song = requested_song.split('/')[-1]
-            if '?' in requested_song:
-                requested_song = requested_song.split('?')[0]
-            query = spotify.get_track_by_id(self.twitch_manager.manager.configuration['spotify-token']['access_token'],
-                                            requested_song)
-            spotify.add_song_id(self.twitch_manager.manager.configuration['spotify-token']['access_token'],
-                                requested_song)
+    async def sbagliato(self, message):
+        await send_message(self.twitch_manager, 'Oh No', priority=CHATTER)
+
+    async def sr(self, message):
+        await self.request_songs(message)
+
+    # Same as !sr, but not bound by the per user limit of the queue
+    async def srbatch(self, message):
+        await self.request_songs(message, bypass_limits=True)
+
+    async def request_songs(self, message, bypass_limits=False):
+        requested_song = message.bot_command_params
+        if not requested_song:
+            return
+        link = parse_spotify_link(requested_song)
+        if link is not None and link[0] in COLLECTION_NAMES:
+            # Up to queue/max_batch Spotify calls, the chat connection keeps reading while they run
+            self.run_in_background(self.request_collection(message, *link, bypass_limits=bypass_limits))
+            return
+        if link is not None:
+            query = await self.spotify.get_track_by_id(link[1])
+        elif re.search(URL_PATTERN, requested_song):
+            self.twitch_manager.manager.print.print_to_logs(f"Not a Spotify link: {requested_song}",
+                                                            self.twitch_manager.manager.print.YELLOW)
+            return
         else:
-            query = spotify.query_for_song(self.twitch_manager.manager.configuration['spotify-token']['access_token'],
-                                           requested_song)
-            spotify.add_song_id(self.twitch_manager.manager.configuration['spotify-token']['access_token'], query['id'])
-            # self.queue.append({
-            #     'title': f'{query["name"]}',
-            #     'author': f"{query['artists'][0]['name']}",
-            #     'requested_by': f"{ctx.author.display_name}",
-            #     'duration': query['duration_ms']
-            # })
-            # print_queue_to_file(self.queue)
+            query = await self.spotify.query_for_song(requested_song)
+        if not query:
+            self.twitch_manager.manager.print.print_to_logs(f"No results for {requested_song}",
+                                                            self.twitch_manager.manager.print.YELLOW)
+            return
+        match await self.add_track(query, message, bypass_limits):
+            case song_queue.DUPLICATE:
+                await send_message(self.twitch_manager, f"{query['name']} è già in coda!")
+            case song_queue.USER_LIMIT:
+                await send_message(self.twitch_manager, f"@{message.display_name} hai già "
+                                                        f"{self.song_queue.max_per_user} canzoni in coda!")
+            case None:
+                self.twitch_manager.manager.print.print_to_logs(
+                    f"Aggiunto {query['name']} - {query['artists'][0]['name']} alla coda!",
+                    self.twitch_manager.manager.print.BRIGHT_PURPLE)
+                await send_message(self.twitch_manager,
+                                   f"Aggiunto {query['name']} - {query['artists'][0]['name']}!")
+
+    async def request_collection(self, message, kind, collection_id, bypass_limits=False):
+        # Pages are fetched concurrently while the tracks already received are queued one at a time,
+        # Spotify appends to its queue in request order so the adds themselves stay sequential
+        results = {None: 0, song_queue.DUPLICATE: 0, song_queue.USER_LIMIT: 0, REFUSED: 0}
+        tracks = self.spotify.get_collection_tracks(kind, collection_id, self.song_queue.max_batch)
+        try:
+            async for track in tracks:
+                result = await self.add_track(track, message, bypass_limits)
+                results[result] += 1
+                if result in (song_queue.USER_LIMIT, REFUSED):
+                    break
+        finally:
+            await tracks.aclose()
         self.twitch_manager.manager.print.print_to_logs(
-            f"Aggiunto {query['name']} - {query['artists'][0]['name']} alla coda!",
-                                         self.twitch_manager.manager.print.BRIGHT_PURPLE)
-        await send_message(self.twitch_manager, f"Aggiunto {query['name']} - {query['artists'][0]['name']}!")
+            f"{message.display_name} requested {kind} {collection_id}: {results[None]} added, "
+            f"{results[song_queue.DUPLICATE]} already queued", self.twitch_manager.manager.print.BRIGHT_PURPLE)
+
+        summary = f"@{message.display_name} aggiunte {results[None]} canzoni {COLLECTION_NAMES[kind]}"
+        if results[song_queue.DUPLICATE]:
+            summary += f", {results[song_queue.DUPLICATE]} erano già in coda"
+        if results[song_queue.USER_LIMIT]:
+            summary += f", hai raggiunto il limite di {self.song_queue.max_per_user} canzoni"
+        if results[REFUSED]:
+            summary += ", Spotify ha rifiutato le altre"
+        await send_message(self.twitch_manager, f"{summary}!")
+
+    def run_in_background(self, coroutine):
+        task = create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_done)
+
+    def background_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.twitch_manager.manager.print.print_to_logs(f"Song request failed: {task.exception()!r}",
+                                                            self.twitch_manager.manager.print.RED)
+
+    async def add_track(self, track, message, bypass_limits=False):
+        requester = message.nick or message.display_name.lower()
+        reason = self.song_queue.check(track['id'], requester, bypass_limits)
+        if reason is not None:
+            return reason
+        try:
+            if await self.spotify.add_song_id(track['id']) not in range(200, 299):
+                self.twitch_manager.manager.print.print_to_logs(f"Spotify refused to queue {track['name']}",
+                                                                self.twitch_manager.manager.print.YELLOW)
+                return REFUSED
+            self.song_queue.add(track, requester, message.display_name)
+            return None
+        finally:
+            # Frees the reservation taken by check() if the song did not make it into the queue
+            self.song_queue.release(track['id'])
 
 
-async def send_message(self, message, target=None):
-    # Send a message to the channel or a specific user
-    if target:
-        await self.chat_websocket.send(f"PRIVMSG #{self.channel} :/w {target} {message}")
-    else:
-        await self.chat_websocket.send(f"PRIVMSG #{self.channel} :{message}")
+async def send_message(self, message, target=None, priority=REPLY):
+    # Send a message to the channel or a specific user, it goes out once the rate limit of the channel allows it
+    self.outbound.put(message, target, priority)
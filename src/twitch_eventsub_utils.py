@@ -1,55 +1,266 @@
-import requests
+import json
+from asyncio import gather, wait_for
 
-from src.twitch_ircchat_utils import replace_keywords
+import websockets
+from websockets import ConnectionClosed
 
-TWITCH_EVENTSUB_URL = 'https://api.twitch.tv/helix/eventsub/subscriptions'
+EVENTSUB_URL = 'wss://eventsub.wss.twitch.tv/ws'
+WELCOME_TIMEOUT = 10
+KEEPALIVE_MARGIN = 5
+# How long the old session is still read after moving to the new one
+DRAIN_TIMEOUT = 1
 
+# Condition fields, filled with the id of the authenticated user
+BROADCASTER = ('broadcaster_user_id',)
+BROADCASTER_AND_MODERATOR = ('broadcaster_user_id', 'moderator_user_id')
+BROADCASTER_AND_USER = ('broadcaster_user_id', 'user_id')
 
-def subscribe_to_follow(self, session_id):
-    data = {
-        'type': 'channel.follow',
-        'version': '2',
-        'condition': {
-            "broadcaster_user_id": self.user['data'][0]['id'],
-            "moderator_user_id": self.user['data'][0]['id']
-        },
-        'transport': {
-            'method': 'websocket',
-            'session_id': session_id
-        }
+# Every subscription the bot knows about: version, condition fields and the scope the token needs for it
+EVENTSUB_SUBSCRIPTIONS = {
+    'channel.follow': {'version': '2', 'condition': BROADCASTER_AND_MODERATOR, 'scope': 'moderator:read:followers'},
+    'channel.subscribe': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:subscriptions'},
+    'channel.subscription.gift': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:subscriptions'},
+    'channel.subscription.message': {'version': '1', 'condition': BROADCASTER,
+                                     'scope': 'channel:read:subscriptions'},
+    'channel.cheer': {'version': '1', 'condition': BROADCASTER, 'scope': 'bits:read'},
+    'channel.channel_points_custom_reward_redemption.add': {'version': '1', 'condition': BROADCASTER,
+                                                            'scope': 'channel:read:redemptions'},
+    'channel.raid': {'version': '1', 'condition': ('to_broadcaster_user_id',), 'scope': None},
+    'channel.ad_break.begin': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:ads'},
+    'channel.ban': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:moderate'},
+    'channel.chat.clear': {'version': '1', 'condition': BROADCASTER_AND_USER, 'scope': 'user:read:chat'},
+    'channel.chat.message_delete': {'version': '1', 'condition': BROADCASTER_AND_USER, 'scope': 'user:read:chat'},
+    'channel.poll.begin': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:polls'},
+    'channel.poll.end': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:polls'},
+    'channel.prediction.begin': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:predictions'},
+    'channel.prediction.end': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:predictions'},
+    'channel.hype_train.begin': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:hype_train'},
+    'channel.hype_train.end': {'version': '1', 'condition': BROADCASTER, 'scope': 'channel:read:hype_train'},
+    'channel.shield_mode.begin': {'version': '1', 'condition': BROADCASTER_AND_MODERATOR,
+                                  'scope': 'moderator:read:shield_mode'},
+    'channel.shield_mode.end': {'version': '1', 'condition': BROADCASTER_AND_MODERATOR,
+                                'scope': 'moderator:read:shield_mode'},
+    'automod.message.hold': {'version': '1', 'condition': BROADCASTER_AND_MODERATOR,
+                             'scope': 'moderator:manage:automod'},
+    'user.whisper.message': {'version': '1', 'condition': ('user_id',), 'scope': 'user:read:whispers'}
+}
+
+
+def configured_subscriptions(self):
+    events = self.manager.configuration['eventsub']['events']
+    if events == 'all':
+        return list(EVENTSUB_SUBSCRIPTIONS)
+    wanted = [event.strip() for event in events.split(',') if event.strip()]
+    for event in wanted:
+        if event not in EVENTSUB_SUBSCRIPTIONS:
+            self.manager.print.print_to_logs(f"Unknown EventSub subscription {event}", self.manager.print.YELLOW)
+    return [event for event in wanted if event in EVENTSUB_SUBSCRIPTIONS]
+
+
+def subscription_condition(subscription_type, broadcaster_id, user_id):
+    # The moderator and user fields name the account the bot runs as, which is only the broadcaster on its own channel
+    return {field: user_id if field in ('moderator_user_id', 'user_id') else broadcaster_id
+            for field in EVENTSUB_SUBSCRIPTIONS[subscription_type]['condition']}
+
+
+def subscription_request(subscription_type, broadcaster_id, user_id, transport):
+    return {
+        'type': subscription_type,
+        'version': EVENTSUB_SUBSCRIPTIONS[subscription_type]['version'],
+        'condition': subscription_condition(subscription_type, broadcaster_id, user_id),
+        'transport': transport
     }
 
-    response = requests.post(TWITCH_EVENTSUB_URL, headers=self.headers, json=data, timeout=5)
-    return response.json()
-
-
-def subscribe_to_sub(self, session_id):
-    data = {
-        'type': 'channel.follow',
-        'version': '2',
-        'condition': {
-            "broadcaster_user_id": self.user['data'][0]['id'],
-            "moderator_user_id": self.user['data'][0]['id']
-        },
-        'transport': {
-            'method': 'websocket',
-            'session_id': session_id
-        }
+
+def websocket_transport(session_id):
+    return {
+        'method': 'websocket',
+        'session_id': session_id
     }
 
-    response = requests.post(TWITCH_EVENTSUB_URL, headers=self.headers, json=data, timeout=5)
-    return response.json()
+
+async def create_subscription(self, helix, subscription_type, broadcaster_id, user_id, transport):
+    status, response = await helix.create_eventsub_subscription(
+        subscription_request(subscription_type, broadcaster_id, user_id, transport))
+    if status in range(200, 299) or status == 409:
+        return True
+    scope = EVENTSUB_SUBSCRIPTIONS[subscription_type]['scope']
+    hint = f" (the token needs the {scope} scope, authorize again)" if status == 403 and scope else ''
+    self.manager.print.print_to_logs(f"Could not subscribe to {subscription_type} for {broadcaster_id}: "
+                                     f"{response.get('message', status)}{hint}", self.manager.print.YELLOW)
+    return False
+
+
+async def open_session(self, url):
+    # Returns the websocket and the session from its welcome message
+    websocket = await websockets.connect(url, ssl=self.ssl_context)
+    try:
+        message = json.loads(await wait_for(websocket.recv(), WELCOME_TIMEOUT))
+    except BaseException:
+        await websocket.close()
+        raise
+    self.seen_messages.seen(message['metadata']['message_id'])
+    return websocket, message['payload']['session']
+
+
+def keepalive_timeout(session):
+    # No message at all (keepalives included) for longer than this means the connection is dead
+    return session['keepalive_timeout_seconds'] + KEEPALIVE_MARGIN
+
+
+async def drain_session(self, websocket):
+    # Events already sent on the old session are still read, the dedup window drops the repeated ones
+    try:
+        while True:
+            self.handle_eventsub_message(json.loads(await wait_for(websocket.recv(), DRAIN_TIMEOUT)))
+    except (TimeoutError, ConnectionClosed):
+        pass
+    finally:
+        await websocket.close()
+
+
+async def reconcile_subscriptions(self, session_id):
+    # Twitch expects the subscriptions within a few seconds of the welcome message, so all requests run in parallel
+    wanted = configured_subscriptions(self)
+    existing = await self.manager.helix.get_eventsub_subscriptions()
+    active = set()
+    stale = []
+    for subscription in existing:
+        if subscription['transport'].get('session_id') == session_id and subscription['status'] == 'enabled':
+            active.add(subscription['type'])
+        elif subscription['transport'].get('method') == 'websocket' and subscription['status'] != 'enabled':
+            # Left over from a closed session, it would only count against the subscription limit
+            stale.append(subscription['id'])
+    missing = [subscription_type for subscription_type in wanted if subscription_type not in active]
+    results = await gather(*(create_subscription(self, self.manager.helix, subscription_type, self.user['id'],
+                                                 self.user['id'], websocket_transport(session_id))
+                             for subscription_type in missing),
+                           *(self.manager.helix.delete_eventsub_subscription(subscription_id)
+                             for subscription_id in stale))
+    created = sum(1 for result in results[:len(missing)] if result)
+    self.manager.print.print_to_logs(f"EventSub: {created} subscriptions created, {len(active)} already active, "
+                                     f"{len(missing) - created} failed, {len(stale)} stale removed",
+                                     self.manager.print.BRIGHT_PURPLE)
+
+
+def handle_follow(self, event):
+    self.manager.print.print_to_logs(f"{event['user_name']} ti sta seguendo!", self.manager.print.ORANGE)
+
+
+def handle_subscribe(self, event):
+    if not event['is_gift']:
+        self.manager.print.print_to_logs(f"{event['user_name']} si è abbonato (tier {event['tier'][0]})!",
+                                         self.manager.print.ORANGE)
+
+
+def handle_subscription_gift(self, event):
+    gifter = 'Anonimo' if event['is_anonymous'] else event['user_name']
+    self.manager.print.print_to_logs(f"{gifter} ha regalato {event['total']} abbonamenti!", self.manager.print.ORANGE)
+
+
+def handle_subscription_message(self, event):
+    self.manager.print.print_to_logs(f"{event['user_name']} si è riabbonato per {event['cumulative_months']} mesi: "
+                                     f"{event['message']['text']}", self.manager.print.ORANGE)
+
+
+def handle_cheer(self, event):
+    cheerer = 'Anonimo' if event['is_anonymous'] else event['user_name']
+    self.manager.print.print_to_logs(f"{cheerer} ha donato {event['bits']} bits: {event['message']}",
+                                     self.manager.print.ORANGE)
+
+
+def handle_redemption(self, event):
+    self.manager.print.print_to_logs(f"{event['user_name']} ha riscattato {event['reward']['title']}",
+                                     self.manager.print.ORANGE)
+
+
+def handle_raid(self, event):
+    self.manager.print.print_to_logs(f"{event['from_broadcaster_user_name']} sta raidando con {event['viewers']} "
+                                     f"spettatori!", self.manager.print.ORANGE)
+
+
+def handle_ad_break(self, event):
+    self.manager.print.print_to_logs(f"Pubblicità di {event['duration_seconds']} secondi iniziata",
+                                     self.manager.print.ORANGE)
+
+
+def handle_ban(self, event):
+    duration = 'permanentemente' if event['is_permanent'] else 'temporaneamente'
+    self.manager.print.print_to_logs(f"{event['moderator_user_name']} ha bannato {duration} {event['user_name']}: "
+                                     f"{event['reason']}", self.manager.print.ORANGE)
+
+
+def handle_chat_clear(self, event):
+    self.manager.print.print_to_logs('La chat è stata pulita', self.manager.print.ORANGE)
+
+
+def handle_message_delete(self, event):
+    self.manager.print.print_to_logs(f"Messaggio di {event['target_user_name']} eliminato",
+                                     self.manager.print.ORANGE)
+
+
+def handle_poll(self, event):
+    self.manager.print.print_to_logs(f"Sondaggio {event['title']}: {event.get('status', 'iniziato')}",
+                                     self.manager.print.ORANGE)
+
+
+def handle_prediction(self, event):
+    self.manager.print.print_to_logs(f"Pronostico {event['title']}: {event.get('status', 'iniziato')}",
+                                     self.manager.print.ORANGE)
+
+
+def handle_hype_train(self, event):
+    self.manager.print.print_to_logs(f"Hype Train livello {event['level']}", self.manager.print.ORANGE)
+
+
+def handle_shield_mode(self, event):
+    state = 'terminata' if 'ended_at' in event else 'attivata'
+    self.manager.print.print_to_logs(f"Shield mode {state} da {event['moderator_user_name']}",
+                                     self.manager.print.ORANGE)
+
+
+def handle_automod_hold(self, event):
+    self.manager.print.print_to_logs(f"AutoMod ha trattenuto un messaggio di {event['user_name']}: "
+                                     f"{event['message']['text']}", self.manager.print.ORANGE)
+
+
+def handle_whisper(self, event):
+    self.manager.print.print_to_logs(f"Whisper da {event['from_user_name']}: {event['whisper']['text']}",
+                                     self.manager.print.ORANGE)
 
 
-def get_user_info(self):
-    response = requests.get('https://api.twitch.tv/helix/users', headers=self.headers, timeout=5)
-    if response.status_code in range(200, 299):
-        return response.json()
-    return None
+EVENTSUB_HANDLERS = {
+    'channel.follow': handle_follow,
+    'channel.subscribe': handle_subscribe,
+    'channel.subscription.gift': handle_subscription_gift,
+    'channel.subscription.message': handle_subscription_message,
+    'channel.cheer': handle_cheer,
+    'channel.channel_points_custom_reward_redemption.add': handle_redemption,
+    'channel.raid': handle_raid,
+    'channel.ad_break.begin': handle_ad_break,
+    'channel.ban': handle_ban,
+    'channel.chat.clear': handle_chat_clear,
+    'channel.chat.message_delete': handle_message_delete,
+    'channel.poll.begin': handle_poll,
+    'channel.poll.end': handle_poll,
+    'channel.prediction.begin': handle_prediction,
+    'channel.prediction.end': handle_prediction,
+    'channel.hype_train.begin': handle_hype_train,
+    'channel.hype_train.end': handle_hype_train,
+    'channel.shield_mode.begin': handle_shield_mode,
+    'channel.shield_mode.end': handle_shield_mode,
+    'automod.message.hold': handle_automod_hold,
+    'user.whisper.message': handle_whisper
+}
 
 
 def handle_eventsub_messages(self, message):
-    match message['metadata']['subscription_type']:
-        case 'channel.follow':
-            message = replace_keywords("[user_name] ti sta seguendo!", message)
-            self.manager.print.print_to_logs(message, self.manager.print.ORANGE)
+    match message['metadata']['message_type']:
+        case 'notification':
+            handler = EVENTSUB_HANDLERS.get(message['metadata']['subscription_type'])
+            if handler is not None:
+                handler(self, message['payload']['event'])
+        case 'revocation':
+            subscription = message['payload']['subscription']
+            self.manager.print.print_to_logs(f"EventSub subscription {subscription['type']} revoked: "
+                                             f"{subscription['status']}", self.manager.print.YELLOW)
@@ -0,0 +1,136 @@
+from asyncio import gather, sleep
+from time import time
+
+from cache_utils import TTLCache
+from http_client import AsyncHttpClient, json_body
+
+# /helix/users takes at most 100 id and login parameters per call
+USERS_PER_CALL = 100
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 60 * 60
+# Longest wait for the rate limit bucket to refill, Twitch refills it every minute
+MAX_RESET_WAIT = 60
+
+
+def chunked(items, size):
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+class HelixClient(AsyncHttpClient):
+    base_url = 'https://api.twitch.tv/helix'
+
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+        # Users are cached under both 'id:<id>' and 'login:<login>'
+        self.users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.ratelimit_limit = None
+        self.ratelimit_remaining = None
+        self.ratelimit_reset = 0
+        self.throttled = 0
+
+    def auth_headers(self):
+        return {
+            'Authorization': f"Bearer {self.manager.configuration['twitch-token']['access_token']}",
+            'Client-Id': self.manager.configuration['twitch']['client_id']
+        }
+
+    def update_rate_limit(self, headers):
+        if 'Ratelimit-Remaining' in headers:
+            self.ratelimit_limit = int(headers.get('Ratelimit-Limit', 0)) or self.ratelimit_limit
+            self.ratelimit_remaining = int(headers['Ratelimit-Remaining'])
+            self.ratelimit_reset = int(headers.get('Ratelimit-Reset', 0))
+
+    async def wait_for_bucket(self):
+        if self.ratelimit_remaining is not None and self.ratelimit_remaining <= 0:
+            delay = min(self.ratelimit_reset - time(), MAX_RESET_WAIT)
+            if delay > 0:
+                self.throttled += 1
+                self.manager.print.print_to_logs(f"Helix rate limit reached, waiting {delay:.0f}s",
+                                                 self.manager.print.YELLOW)
+                await sleep(delay)
+            self.ratelimit_remaining = None
+
+    async def send(self, method, url, **kwargs):
+        await self.wait_for_bucket()
+        response = await super().send(method, url, **kwargs)
+        self.update_rate_limit(response.headers)
+        if response.status_code == 429:
+            # Someone else spent the bucket (other tools on the same client id), wait for the reset once
+            self.ratelimit_remaining = 0
+            await self.wait_for_bucket()
+            response = await super().send(method, url, **kwargs)
+            self.update_rate_limit(response.headers)
+        return response
+
+    def remember_users(self, users):
+        for user in users:
+            self.users.put(f"id:{user['id']}", user)
+            self.users.put(f"login:{user['login']}", user)
+
+    async def fetch_users(self, params):
+        response = await self.request('GET', '/users', params=params)
+        if response.status_code not in range(200, 299):
+            self.manager.print.print_to_logs(f"Helix user lookup failed: {response.status_code}",
+                                             self.manager.print.YELLOW)
+            return []
+        users = response.json()['data']
+        self.remember_users(users)
+        return users
+
+    # The user the token belongs to
+    async def get_authenticated_user(self):
+        users = await self.fetch_users({})
+        return users[0] if users else None
+
+    # Users by id and/or login, missing ones are requested 100 at a time and in parallel
+    async def get_users(self, ids=(), logins=()):
+        keys = [('id', str(user_id)) for user_id in ids] + [('login', login.lower()) for login in logins]
+        users = {}
+        missing = []
+        for kind, value in dict.fromkeys(keys):
+            user = self.users.get(f"{kind}:{value}")
+            if user is not None:
+                users[user['id']] = user
+            else:
+                missing.append((kind, value))
+        results = await gather(*(self.fetch_users(chunk) for chunk in chunked(missing, USERS_PER_CALL)))
+        for chunk_users in results:
+            for user in chunk_users:
+                users[user['id']] = user
+        return list(users.values())
+
+    async def get_user(self, user_id=None, login=None):
+        users = await self.get_users(ids=[user_id] if user_id else (), logins=[login] if login else ())
+        return users[0] if users else None
+
+    async def create_eventsub_subscription(self, data):
+        response = await self.request('POST', '/eventsub/subscriptions', json=data)
+        return response.status_code, json_body(response)
+
+    async def get_eventsub_subscriptions(self):
+        subscriptions = []
+        params = {}
+        while True:
+            response = await self.request('GET', '/eventsub/subscriptions', params=params)
+            if response.status_code not in range(200, 299):
+                return subscriptions
+            page = json_body(response)
+            subscriptions.extend(page.get('data', []))
+            cursor = page.get('pagination', {}).get('cursor')
+            if not cursor:
+                return subscriptions
+            params = {'after': cursor}
+
+    async def delete_eventsub_subscription(self, subscription_id):
+        response = await self.request('DELETE', '/eventsub/subscriptions', params={'id': subscription_id})
+        return response.status_code
+
+    def stats(self):
+        return {
+            'users': self.users.stats(),
+            'ratelimit_limit': self.ratelimit_limit,
+            'ratelimit_remaining': self.ratelimit_remaining,
+            'throttled': self.throttled
+        }
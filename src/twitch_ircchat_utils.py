@@ -2,55 +2,105 @@ import json
 import os
 import re
 import string
-from asyncio import create_task
-from time import time
+from copy import deepcopy
+from time import time, perf_counter
 from urllib.parse import urlencode
 from webbrowser import open as wbopen
 
 import requests
+from websockets import ConnectionClosed
 
+from ai_helper import analyse_and_print
+from chat_queue import CHATTER, MODERATION
+from cooldowns import COMMAND, GLOBAL, USER
 from defaults import DEFAULT_COMMANDS
-from src.ai_helper import analyse_and_print
-from twitch_commands import FUNCTION_LIST, send_message
+from twitch_commands import FUNCTION_LIST, FUNCTION_LEVELS, SPOTIFY_FUNCTIONS, send_message
 
 COMMANDS_FILE = 'config/commands.json'
 KEYWORD_PATTERN = r'\[([^\]]+)\]'
-SCOPE_TWITCH = 'chat:read chat:edit moderator:read:followers'
+# Chat, plus every scope needed by the subscriptions in twitch_eventsub_utils.EVENTSUB_SUBSCRIPTIONS
+SCOPE_TWITCH = ('chat:read chat:edit moderator:read:followers channel:read:subscriptions bits:read '
+                'channel:read:redemptions channel:read:ads channel:moderate user:read:chat channel:read:polls '
+                'channel:read:predictions channel:read:hype_train moderator:read:shield_mode '
+                'moderator:manage:automod user:read:whispers')
 
 # Necessary Links for authorization
 TWITCH_AUTHORIZATION_URL = 'https://id.twitch.tv/oauth2/authorize'
 TWITCH_TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
 
+# Badge bitmask used for permission checks
+BADGE_BROADCASTER = 1
+BADGE_MOD = 2
+BADGE_VIP = 4
+BADGE_SUB = 8
+BADGE_FLAGS = {
+    'broadcaster': BADGE_BROADCASTER,
+    'moderator': BADGE_MOD,
+    'vip': BADGE_VIP,
+    'subscriber': BADGE_SUB,
+    'founder': BADGE_SUB
+}
+BADGE_LABELS = (('BROADCASTER', BADGE_BROADCASTER), ('MOD', BADGE_MOD), ('VIP', BADGE_VIP), ('SUB', BADGE_SUB))
+# 'BROADCASTER' > 'MOD' > 'VIP' > 'SUB' > 'ANY'
+PERMISSION_LEVELS = {
+    'BROADCASTER': BADGE_BROADCASTER,
+    'MOD': BADGE_BROADCASTER | BADGE_MOD,
+    'VIP': BADGE_BROADCASTER | BADGE_MOD | BADGE_VIP,
+    'SUB': BADGE_BROADCASTER | BADGE_MOD | BADGE_VIP | BADGE_SUB
+}
+
+TAG_ESCAPE_PATTERN = re.compile(r'\\.?')
+TAG_ESCAPES = {'\\s': ' ', '\\:': ';', '\\\\': '\\', '\\r': '\r', '\\n': '\n', '\\': ''}
+
 
 async def authenticate(self, websocket):
     # Send PASS and NICK commands to authenticate
     await websocket.send('CAP REQ :twitch.tv/membership twitch.tv/tags twitch.tv/commands')
     await websocket.send(f"PASS oauth:{self.manager.configuration['twitch-token']['access_token']}")
-    await websocket.send(f"NICK {self.channel}")
+    await websocket.send(f"NICK {self.bot.nick}")
 
 
-async def join_channel(self, websocket):
-    # Join the specified channel
-    await websocket.send(f"JOIN #{self.channel}")
-    load_commands(self)
-    self.manager.print.print_to_logs(f'Logged in to the chat of {self.channel}', self.manager.print.GREEN)
+async def join_channels(self, websocket):
+    # Join every channel of this connection, the JOIN budget is shared with the other connections
+    for channel in self.channels:
+        await self.bot.join_limiter.acquire()
+        await websocket.send(f"JOIN #{channel.channel}")
+    self.manager.print.print_to_logs(
+        f"Logged in to the chat of {', '.join(channel.channel for channel in self.channels)} "
+        f"({perf_counter() - self.manager.startup_time:.2f}s after startup)", self.manager.print.GREEN)
+    # The chat is up, the model can now be loaded without delaying it
+    self.manager.analyser.warm_up_in_background()
 
 
 def format_message(message):
-    sub = '[SUB]' if message['tags']['subscriber'] else ''
-    vip = '[VIP]' if message['tags']['vip'] else ''
-    mod = '[MOD]' if message['tags']['mod'] else ''
-    broadcaster = '[BROADCASTER]' if message['tags']['broadcaster'] else ''
-    tags = f"{broadcaster}{mod}{vip}{sub}"
-    author = f"{tags}{message['tags']['display-name']}"
-    return f"{author}: {message['parameters'].strip('\r\n')}"
-
-
-async def handle_irc_message(self, message):
-    # Split the message into parts to identify the command
-    message = parse_message(message)
+    tags = ''.join(f'[{label}]' for label, flag in BADGE_LABELS if message.permissions & flag)
+    return f"{tags}{message.display_name}: {message.parameters}"
+
+
+async def handle_irc_frame(self, frame):
+    # Twitch packs several \r\n separated lines in a single frame during bursts
+    messages = [message for message in map(parse_message, frame.split('\r\n')) if message]
+    chat_messages = [message for message in messages if message.command == 'PRIVMSG']
+    if chat_messages:
+        # The dashboard gets the chat lines of the whole frame in one put, everything else is handled per message
+        self.manager.queue.put([format_message(message) for message in chat_messages])
+    log_lines = []
+    for message in messages:
+        try:
+            await handle_irc_message(self, message, log_lines)
+        except ConnectionClosed:
+            raise
+        except Exception as e:
+            # A failing command or API call only loses that message, the connection keeps reading
+            self.manager.print.print_to_logs(f"Error while handling {message.command}: {e!r}",
+                                             self.manager.print.RED)
+    if log_lines:
+        self.manager.print.print_batch_to_logs(log_lines, self.manager.print.BLUE)
+
+
+async def handle_irc_message(self, message, log_lines):
     if message:
-        match message['command']['command']:
+        match message.command:
             case 'JOIN':
                 # Handle JOIN message
                 pass
@@ -58,26 +108,30 @@ async def handle_irc_message(self, message):
                 # Handle NICK message
                 pass
             case 'NOTICE':
-                print(message)
+                # msg-id tells which notice it was (rate limits, banned, bad command...)
+                self.manager.print.print_to_logs(f"Notice in #{message.channel} ({message.tags.get('msg-id')}): "
+                                                 f"{message.parameters}", self.manager.print.YELLOW)
             case 'PART':
                 # Handle PART message
                 pass
             case 'PING':
-                await self.chat_websocket.send('PONG')
+                await self.websocket.send(f'PONG :{message.parameters}')
             case 'PRIVMSG':
-                display_message = format_message(message)
-                self.manager.queue.put(display_message)
-                if len(self.twitch_commands.command_timeout) > 0:
-                    for _, a in self.twitch_commands.command_timeout.items():
-                        if a['remaining_buffer_messages'] > 0:
-                            a['remaining_buffer_messages'] -= 1
-                if message['command'].get('botCommand'):
-                    self.manager.print.print_to_logs(
-                        f"{message['tags']['display-name']}, {message['parameters'].strip('\r\n')}",
-                        self.manager.print.BLUE)
-                    await handle_commands(self, message)
+                # Each message is handled with the tables and cooldowns of the channel it was sent in
+                channel = self.bot.channels.get(message.channel)
+                if channel is None:
+                    return
+                # Counted one at a time, so the messages after a command in the same frame count for its cooldown
+                channel.twitch_commands.cooldowns.count(1)
+                if self.manager.automod.check(message):
+                    # Banned terms are never scored nor allowed to run commands, the warning goes out before any reply
+                    await send_message(channel, f"@{message.display_name} il tuo messaggio contiene termini non "
+                                                f"consentiti", priority=MODERATION)
+                elif message.bot_command:
+                    log_lines.append(f"{message.display_name}, {message.parameters}")
+                    await handle_commands(channel, message)
                 else:
-                    await create_task(analyse_and_print(self, message))
+                    analyse_and_print(channel, message)
                 # Handle PRIVMSG message
             case 'CLEARCHAT':
                 # Handle CLEARCHAT message
@@ -92,8 +146,7 @@ async def handle_irc_message(self, message):
                 # Handle HOSTTARGET message
                 pass
             case 'RECONNECT':
-                # Handle RECONNECT message
-                pass
+                await self.reconnect()
             case 'ROOMSTATE':
                 # Handle ROOMSTATE message
                 pass
@@ -101,8 +154,10 @@ async def handle_irc_message(self, message):
                 # Handle USERNOTICE message
                 pass
             case 'USERSTATE':
-                # Handle USERSTATE message
-                pass
+                # Sent after joining and after each of our messages, it tells whether the bot moderates the channel
+                channel = self.bot.channels.get(message.channel)
+                if channel is not None:
+                    channel.outbound.update_role(bool(message.permissions & PERMISSION_LEVELS['MOD']))
             case 'WHISPER':
                 # Handle WHISPER message
                 pass
@@ -113,72 +168,87 @@ async def handle_irc_message(self, message):
 
 
 async def handle_commands(self, message):
-    command = message['command'].get('botCommand')
+    command = message.bot_command
     if self.simple_commands.get(command):
-        if is_user_allowed(self, message['tags'], self.simple_commands[command]['level']):
+        if is_user_allowed(self, message, self.simple_commands[command]['level']) and \
+                check_cooldowns(self, message, command, self.simple_commands[command]):
             answer = self.simple_commands[command]['message']
             answer = replace_keywords(answer, message)
-            if (command in self.twitch_commands.command_timeout and
-                (self.twitch_commands.command_timeout[command]['wait_until'] >= time() or
-                self.twitch_commands.command_timeout[command]['remaining_buffer_messages'] > 0)):
-                time_left = f"{self.twitch_commands.command_timeout[command]['wait_until'] - int(time())} seconds" if \
-                    self.twitch_commands.command_timeout[command]['wait_until'] > int(time()) else ""
-                buffer = f"{self.twitch_commands.command_timeout[command]['remaining_buffer_messages']} messages" if \
-                    self.twitch_commands.command_timeout[command]['remaining_buffer_messages'] > 0 else ""
-                message = f"{time_left}{' and ' if time_left != '' and buffer != '' else ''}{buffer}"
-                self.manager.print.print_to_logs(
-                    f"Timeout in effect! Remaining {message}",
-                    self.manager.print.YELLOW)
-            else:
-                self.twitch_commands.command_timeout[command] = {}
-                self.twitch_commands.command_timeout[command]['wait_until'] = int(time()) + int(self.simple_commands[command]['timeout'])
-                self.twitch_commands.command_timeout[command]['remaining_buffer_messages'] = self.simple_commands[command]['min-messages']
-                await send_message(self, answer)
+            await send_message(self, answer, priority=CHATTER)
     elif self.complex_commands.get(command):
-        if is_user_allowed(self, message['tags'], self.complex_commands[command]['level']):
+        if command in SPOTIFY_FUNCTIONS and self.manager.spotify is None:
+            # Supervisor workers have no Spotify, it stays with the process of the primary channel
+            self.manager.print.print_to_logs(f"Command {command} needs Spotify, not available for #{self.channel}",
+                                             self.manager.print.YELLOW)
+            return
+        if is_user_allowed(self, message, self.complex_commands[command]['level']) and \
+                check_cooldowns(self, message, command, self.complex_commands[command]):
             func = getattr(self.twitch_commands, command)
-            await func(
-                message['command'].get('botCommandParams') if message['command'].get('botCommandParams') else None)
-
-
-def is_user_allowed(self, author, level):
-    match level:
-        case 'BROADCASTER':
-            if author['broadcaster']:
-                return True
-        case 'MOD':
-            if author['mod'] or author['broadcaster']:
-                return True
-        case 'VIP':
-            if author['vip'] or author['mod'] or author['broadcaster']:
-                return True
-        case 'SUB':
-            if author['subscriber'] or author['vip'] or author['mod'] or author['broadcaster']:
-                return True
-        case _:
-            return True
-
-    # If none of the above cases match, it means the user is not allowed
-    self.manager.print.print_to_logs(f'User {author.display_name} not allowed to run this command',
+            await func(message)
+
+
+def check_cooldowns(self, message, command, context):
+    # Global, per command and per user cooldowns, the command only runs if none of them is active
+    user = message.nick or message.display_name.lower()
+    scopes = [
+        ((GLOBAL,), int(self.manager.configuration['commands']['global_timeout']), 0),
+        ((COMMAND, command), int(context.get('timeout', 0)), int(context.get('min-messages', 0))),
+        ((USER, command, user), int(context.get('user-timeout', 0)), 0)
+    ]
+    cooldowns = self.twitch_commands.cooldowns
+    blocked = cooldowns.blocking(key for key, _, _ in scopes)
+    if blocked is not None:
+        key, seconds, messages = blocked
+        remaining = ' and '.join(part for part in (f"{seconds:.0f} seconds" if seconds else '',
+                                                   f"{messages} messages" if messages else '') if part)
+        self.manager.print.print_to_logs(f"Timeout in effect ({key[0]})! Remaining {remaining}",
+                                         self.manager.print.YELLOW)
+        return False
+    for key, seconds, messages in scopes:
+        cooldowns.start(key, seconds, messages)
+    return True
+
+
+def is_user_allowed(self, message, level):
+    required = PERMISSION_LEVELS.get(level)
+    if required is None or message.permissions & required:
+        return True
+
+    # If none of the required badges are present, it means the user is not allowed
+    self.manager.print.print_to_logs(f'User {message.display_name} not allowed to run this command',
                                      self.manager.print.YELLOW)
     return False
 
 
 def load_commands(self):
-    if os.path.exists(COMMANDS_FILE):
-        with open(COMMANDS_FILE, 'r', encoding='utf-8') as f:
+    if os.path.exists(self.commands_file):
+        with open(self.commands_file, 'r', encoding='utf-8') as f:
             commands_json = json.load(f)
+        # Commands added after the file was created are appended with their default level
+        missing = [command for command in FUNCTION_LIST if command not in commands_json['complex']]
+        for command in missing:
+            commands_json['complex'][command] = {'enabled': self.primary or command not in SPOTIFY_FUNCTIONS,
+                                                 'level': FUNCTION_LEVELS.get(command, 'ANY')}
+        # Older files used min_messages, the dashboard form only reads and writes min-messages
+        renamed = [context for section in ('simple', 'complex') for context in commands_json[section].values()
+                   if 'min_messages' in context]
+        for context in renamed:
+            context.setdefault('min-messages', context.pop('min_messages'))
+        if missing or renamed:
+            with open(self.commands_file, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(commands_json, indent=4))
         load_simple_commands(self, commands_json=commands_json['simple'])
         set_complex_commands(self, commands_json=commands_json['complex'])
     else:
-        self.manager.print.print_to_logs('Commands file not found', self.manager.print.RED)
+        self.manager.print.print_to_logs(f'Commands file for {self.channel} not found', self.manager.print.RED)
         self.manager.print.print_to_logs('Creating new one with default commands', self.manager.print.WHITE)
-        defaults = DEFAULT_COMMANDS
+        defaults = deepcopy(DEFAULT_COMMANDS)
         for command in FUNCTION_LIST:
             defaults['complex'][command] = {}
-            defaults['complex'][command]['enabled'] = True
-            defaults['complex'][command]['level'] = 'ANY'
-        with open('config/commands.json', 'w', encoding='utf-8') as f:
+            # There is a single Spotify account, its commands start disabled on every channel but the primary one
+            defaults['complex'][command]['enabled'] = self.primary or command not in SPOTIFY_FUNCTIONS
+            defaults['complex'][command]['level'] = FUNCTION_LEVELS.get(command, 'ANY')
+        with open(self.commands_file, 'w', encoding='utf-8') as f:
             f.write(json.dumps(defaults, indent=4))
         load_commands(self)
 
@@ -206,139 +276,143 @@ def replace_keywords(message: string, original_message):
         for m in matches:
             match m:
                 case 'sender':
-                    return re.sub(KEYWORD_PATTERN, f"@{original_message['tags']['display-name']}", message)
+                    return re.sub(KEYWORD_PATTERN, f"@{original_message.display_name}", message)
                 case 'user_name':
                     return re.sub(KEYWORD_PATTERN, original_message['payload']['event']['user_name'], message)
     else:
         return message
 
 
-def parse_message(message):
-    parsed_message = {
-        'tags': None,
-        'source': None,
-        'command': None,
-        'parameters': None
-    }
+def parse_message(line):
+    # Single pass over the raw line, tags are kept raw and only decoded when read
+    line = line.rstrip('\r\n')
+    if not line:
+        return None
 
     idx = 0
-    raw_tags_component = None
-    raw_source_component = None
-    raw_command_component = None
-    raw_parameters_component = None
-
-    if message[idx] == '@':
-        end_idx = message.find(' ')
-        raw_tags_component = message[1:end_idx]
+    tags = EMPTY_TAGS
+    source = None
+
+    if line[0] == '@':
+        end_idx = line.find(' ')
+        if end_idx == -1:
+            return None
+        tags = IrcTags(line[1:end_idx])
         idx = end_idx + 1
 
-    if message[idx] == ':':
-        idx += 1
-        end_idx = message.find(' ', idx)
-        raw_source_component = message[idx:end_idx]
+    if line.startswith(':', idx):
+        end_idx = line.find(' ', idx)
+        if end_idx == -1:
+            return None
+        source = line[idx + 1:end_idx]
         idx = end_idx + 1
 
-    end_idx = message.find(':', idx)
+    end_idx = line.find(' :', idx)
     if end_idx == -1:
-        end_idx = len(message)
-
-    raw_command_component = message[idx:end_idx].strip()
-
-    if end_idx != len(message):
-        idx = end_idx + 1
-        raw_parameters_component = message[idx:]
-
-    parsed_message['command'] = parse_command(raw_command_component)
-
-    if parsed_message['command'] is None:
-        return None
+        command_component = line[idx:]
+        parameters = None
     else:
-        if raw_tags_component is not None:
-            parsed_message['tags'] = parse_tags(raw_tags_component)
-
-        parsed_message['source'] = parse_source(raw_source_component)
-        parsed_message['parameters'] = raw_parameters_component
-
-        if raw_parameters_component and raw_parameters_component[0] == '!':
-            parsed_message['command'] = parse_parameters(raw_parameters_component, parsed_message['command'])
-
-    return parsed_message
+        command_component = line[idx:end_idx]
+        parameters = line[end_idx + 2:]
 
-
-def parse_tags(tags):
-    tags_to_ignore = {
-        'client-nonce': None,
-        'flags': None
-    }
-
-    dict_parsed_tags = {}
-    parsed_tags = tags.split(';')
-
-    for tag in parsed_tags:
-        parsed_tag = tag.split('=')
-        tag_value = get_tag_value(parsed_tag)
-        if parsed_tag[0] in tags_to_ignore:
-            continue
-        if parsed_tag[0] == 'badges' and parsed_tag[1]:
-            parsed_tag_value = tag_value.split(',') if ',' in tag_value else tag_value
-            dict_parsed_tags['broadcaster'] = 'broadcaster/1' in parsed_tag_value
-        dict_parsed_tags[parsed_tag[0]] = tag_value
-    if not dict_parsed_tags.get('vip'):
-        dict_parsed_tags['vip'] = False
-    if not dict_parsed_tags.get('broadcaster'):
-        dict_parsed_tags['broadcaster'] = False
-    return dict_parsed_tags
-
-
-def get_tag_value(tag_value):
-    if tag_value[1] == '':
+    command, _, target = command_component.strip().partition(' ')
+    if not command:
         return None
-    elif tag_value[1] == '0' or tag_value[1] == '1':
-        return tag_value[1] == '1'
-    return tag_value[1]
-
+    channel = target.partition(' ')[0][1:] if target.startswith('#') else None
 
-def parse_command(raw_command_component):
-    command_parts = raw_command_component.split(' ')
-    parsed_command = None
+    return IrcMessage(tags, source, command, channel, parameters)
 
-    if command_parts[0] in ['JOIN', 'PART', 'NOTICE', 'CLEARCHAT', 'HOSTTARGET', 'PRIVMSG']:
-        parsed_command = {
-            'command': command_parts[0],
-            'channel': command_parts[1]
-        }
-    elif command_parts[0] == 'PING':
-        parsed_command = {
-            'command': command_parts[0]
-        }
-    # Add other command cases as needed
 
-    return parsed_command
-
-
-def parse_source(raw_source_component):
-    if raw_source_component is None:
+def decode_tag_value(value):
+    if value == '':
         return None
-    else:
-        source_parts = raw_source_component.split('!')
-        return {
-            'nick': source_parts[0] if len(source_parts) == 2 else None,
-            'host': source_parts[1] if len(source_parts) == 2 else source_parts[0]
-        }
-
-
-def parse_parameters(raw_parameters_component, command):
-    idx = 0
-    command_parts = raw_parameters_component[idx + 1:].strip()
-    params_idx = command_parts.find(' ')
-
-    if params_idx == -1:
-        command['botCommand'] = command_parts
-    else:
-        command['botCommand'] = command_parts[:params_idx]
-        command['botCommandParams'] = command_parts[params_idx:].strip()
-
-    return command
+    elif value == '0' or value == '1':
+        return value == '1'
+    elif '\\' in value:
+        return TAG_ESCAPE_PATTERN.sub(lambda m: TAG_ESCAPES.get(m.group(0), m.group(0)[1:]), value)
+    return value
+
+
+class IrcTags:
+    __slots__ = ('raw', 'decoded')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.decoded = {}
+
+    def get(self, key, default=None):
+        if key in self.decoded:
+            return self.decoded[key]
+        if self.raw.startswith(f'{key}='):
+            start = len(key) + 1
+        else:
+            start = self.raw.find(f';{key}=')
+            if start == -1:
+                return default
+            start += len(key) + 2
+        end = self.raw.find(';', start)
+        value = decode_tag_value(self.raw[start:] if end == -1 else self.raw[start:end])
+        self.decoded[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING_TAG)
+        if value is MISSING_TAG:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING_TAG) is not MISSING_TAG
+
+
+MISSING_TAG = object()
+EMPTY_TAGS = IrcTags('')
+
+
+class IrcMessage:
+    __slots__ = ('tags', 'source', 'command', 'channel', 'parameters', 'bot_command', 'bot_command_params',
+                 'permissions_mask')
+
+    def __init__(self, tags, source, command, channel, parameters):
+        self.tags = tags
+        self.source = source
+        self.command = command
+        self.channel = channel
+        self.parameters = parameters
+        self.bot_command = None
+        self.bot_command_params = None
+        self.permissions_mask = None
+        if parameters and parameters[0] == '!':
+            bot_command, _, bot_command_params = parameters[1:].strip().partition(' ')
+            self.bot_command = bot_command or None
+            self.bot_command_params = bot_command_params.strip() or None
+
+    def __repr__(self):
+        return f"IrcMessage({self.command} #{self.channel}: {self.parameters!r})"
+
+    @property
+    def nick(self):
+        if self.source is None:
+            return None
+        end_idx = self.source.find('!')
+        return self.source[:end_idx] if end_idx != -1 else None
+
+    @property
+    def display_name(self):
+        return self.tags.get('display-name') or self.nick
+
+    @property
+    def permissions(self):
+        if self.permissions_mask is None:
+            permissions = 0
+            badges = self.tags.get('badges')
+            if isinstance(badges, str):
+                for badge in badges.split(','):
+                    permissions |= BADGE_FLAGS.get(badge.partition('/')[0], 0)
+            if self.tags.get('mod'):
+                permissions |= BADGE_MOD
+            self.permissions_mask = permissions
+        return self.permissions_mask
 
 
 def retrieve_token_info(client_id, client_secret, code):
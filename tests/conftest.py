@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules import each other both as top level modules and through the src package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), ROOT]
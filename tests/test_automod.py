@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from automod import AhoCorasick, BannedTermMatcher
+
+
+def build(terms):
+    automaton = AhoCorasick()
+    automaton.update(set(terms))
+    return automaton
+
+
+def test_overlapping_terms():
+    automaton = build(['he', 'she', 'hers', 'his'])
+    assert sorted(automaton.search('ushers')) == [(1, 'she'), (2, 'he'), (2, 'hers')]
+
+
+def test_no_match():
+    assert list(build(['abc']).search('ab bc')) == []
+
+
+def test_removed_terms_are_not_matched_nor_kept_in_the_trie():
+    automaton = build(['banana', 'band', 'bar'])
+    automaton.update({'bar'})
+    assert list(automaton.search('banana band bar')) == [(12, 'bar')]
+    assert len(automaton.transitions) == len(build(['bar']).transitions)
+
+
+def test_added_terms_extend_the_trie():
+    automaton = build(['bar'])
+    automaton.update({'bar', 'baz'})
+    assert sorted(term for _, term in automaton.search('bar baz')) == ['bar', 'baz']
+
+
+def matcher(tmp_path, terms):
+    file_name = tmp_path / 'banned_terms.txt'
+    file_name.write_text(terms, encoding='utf-8')
+    manager = SimpleNamespace(print=SimpleNamespace(print_to_logs=lambda *_: None, BRIGHT_PURPLE='', RED=''))
+    return BannedTermMatcher(manager, str(file_name))
+
+
+def test_whole_words_and_leetspeak(tmp_path):
+    banned = matcher(tmp_path, 'badword\nvery  bad phrase # comment\n')
+    assert banned.scan('what a B4DW0RD') == ['badword']
+    assert banned.scan('notbadwords here') == []
+    assert banned.scan('this is a very   bad phrase!') == ['very bad phrase']
+    assert banned.stats()['terms'] == 2
@@ -0,0 +1,75 @@
+import cache_utils
+from cache_utils import DedupWindow, LRUCache, TTLCache
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_counts_hits_and_misses():
+    cache = LRUCache(4)
+    cache.put('a', 1)
+    cache.get('a')
+    assert cache.get('missing', 'default') == 'default'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
+
+
+def test_lru_with_no_room_stores_nothing():
+    cache = LRUCache(0)
+    cache.put('a', 1)
+    assert len(cache) == 0
+
+
+def test_ttl_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_utils, 'time', lambda: now[0])
+    cache = TTLCache(4, ttl=10)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=30)
+    assert cache.get('a') == 1
+    now[0] += 15
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+
+
+def test_ttl_dump_and_restore_skip_expired_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_utils, 'time', lambda: now[0])
+    cache = TTLCache(4, ttl=10)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=100)
+    dump = cache.dump()
+    now[0] += 50
+    restored = TTLCache(4, ttl=10)
+    restored.restore(dump)
+    assert restored.dump() == [['b', 1100.0, 2]]
+
+
+def test_dedup_window_remembers_keys_for_the_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cache_utils, 'monotonic', lambda: now[0])
+    window = DedupWindow(10, ttl=60)
+    assert not window.seen('a')
+    assert window.seen('a')
+    now[0] += 61
+    assert not window.seen('a')
+    assert window.stats()['duplicates'] == 1
+
+
+def test_dedup_window_is_bounded():
+    window = DedupWindow(3, ttl=60)
+    for key in 'abcd':
+        window.seen(key)
+    assert len(window) == 3
+    assert not window.seen('a')
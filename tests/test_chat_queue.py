@@ -0,0 +1,61 @@
+from chat_queue import CHATTER, MODERATION, REPLY, OutboundQueue, split_message
+
+
+class FakeChannel:
+    channel = 'channel'
+
+
+def queued_lines(queue):
+    lines = []
+    while not queue.queue.empty():
+        lines.append(queue.queue.get_nowait()[3])
+    return lines
+
+
+def test_split_keeps_short_messages_whole():
+    assert split_message('hello there') == ['hello there']
+    assert split_message('') == []
+
+
+def test_split_cuts_on_the_last_space():
+    assert split_message('aaa bbb ccc', limit=7) == ['aaa bbb', 'ccc']
+    assert all(len(part) <= 7 for part in split_message('aa bb cc dd ee ff', limit=7))
+
+
+def test_split_cuts_long_words_at_the_limit():
+    assert split_message('a' * 12, limit=5) == ['aaaaa', 'aaaaa', 'aa']
+
+
+def test_queue_sends_by_priority_then_in_order():
+    queue = OutboundQueue(FakeChannel())
+    queue.put('chatter', priority=CHATTER)
+    queue.put('first reply')
+    queue.put('warning', priority=MODERATION)
+    queue.put('second reply', priority=REPLY)
+    assert queued_lines(queue) == ['PRIVMSG #channel :warning', 'PRIVMSG #channel :first reply',
+                                   'PRIVMSG #channel :second reply', 'PRIVMSG #channel :chatter']
+
+
+def test_queue_coalesces_repeated_replies():
+    queue = OutboundQueue(FakeChannel())
+    queue.put('same')
+    queue.put('same')
+    queue.put('same', target='someone')
+    assert queue.coalesced == 1
+    assert queued_lines(queue) == ['PRIVMSG #channel :same', 'PRIVMSG #channel :/w someone same']
+
+
+def test_queue_splits_long_replies_within_the_limit():
+    queue = OutboundQueue(FakeChannel())
+    queue.put(' '.join(['word'] * 200), target='someone')
+    lines = queued_lines(queue)
+    assert len(lines) == 3 and queue.split == 2
+    assert all(len(line.split(' :', 1)[1]) <= 500 for line in lines)
+
+
+def test_queue_never_coalesces_moderation():
+    queue = OutboundQueue(FakeChannel())
+    queue.put('@someone warning', priority=MODERATION)
+    queue.put('@someone warning', priority=MODERATION)
+    assert queue.coalesced == 0
+    assert len(queued_lines(queue)) == 2
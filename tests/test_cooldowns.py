@@ -0,0 +1,58 @@
+import cooldowns
+from cooldowns import COMMAND, GLOBAL, USER, Cooldowns
+
+
+def fake_clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cooldowns, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_time_cooldown_ends(monkeypatch):
+    now = fake_clock(monkeypatch)
+    table = Cooldowns()
+    table.start((COMMAND, 'song'), seconds=30)
+    assert table.remaining((COMMAND, 'song')) == (30, 0)
+    now[0] += 30
+    assert table.remaining((COMMAND, 'song')) == (0, 0)
+    assert table.stats()['active'] == 0
+
+
+def test_message_cooldown_waits_for_chat(monkeypatch):
+    fake_clock(monkeypatch)
+    table = Cooldowns()
+    table.start((COMMAND, 'song'), messages=3)
+    table.count(2)
+    assert table.remaining((COMMAND, 'song')) == (0, 1)
+    table.count(1)
+    assert table.remaining((COMMAND, 'song')) == (0, 0)
+
+
+def test_blocking_returns_the_first_active_scope(monkeypatch):
+    now = fake_clock(monkeypatch)
+    table = Cooldowns()
+    table.start((USER, 'song', 'someone'), seconds=60)
+    table.start((COMMAND, 'song'), seconds=10)
+    keys = [(GLOBAL,), (COMMAND, 'song'), (USER, 'song', 'someone')]
+    assert table.blocking(keys) == ((COMMAND, 'song'), 10, 0)
+    now[0] += 10
+    assert table.blocking(keys) == ((USER, 'song', 'someone'), 50, 0)
+    assert table.blocking([(USER, 'song', 'other')]) is None
+
+
+def test_zero_cooldowns_are_not_stored(monkeypatch):
+    fake_clock(monkeypatch)
+    table = Cooldowns()
+    table.start((GLOBAL,))
+    assert table.stats()['active'] == 0
+
+
+def test_full_table_drops_expired_entries(monkeypatch):
+    now = fake_clock(monkeypatch)
+    monkeypatch.setattr(cooldowns, 'MAX_ENTRIES', 2)
+    table = Cooldowns()
+    table.start((USER, 'song', 'a'), seconds=5)
+    table.start((USER, 'song', 'b'), seconds=50)
+    now[0] += 10
+    table.start((USER, 'song', 'c'), seconds=5)
+    assert set(table.entries) == {(USER, 'song', 'b'), (USER, 'song', 'c')}
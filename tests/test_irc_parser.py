@@ -0,0 +1,77 @@
+from twitch_ircchat_utils import BADGE_BROADCASTER, BADGE_MOD, BADGE_SUB, IrcTags, parse_message
+
+
+def test_privmsg_with_tags():
+    message = parse_message('@badges=broadcaster/1,subscriber/12;display-name=Foo;mod=0 '
+                            ':foo!foo@foo.tmi.twitch.tv PRIVMSG #bar :hello there\r\n')
+    assert message.command == 'PRIVMSG'
+    assert message.channel == 'bar'
+    assert message.source == 'foo!foo@foo.tmi.twitch.tv'
+    assert message.nick == 'foo'
+    assert message.display_name == 'Foo'
+    assert message.parameters == 'hello there'
+    assert message.bot_command is None
+    assert message.permissions == BADGE_BROADCASTER | BADGE_SUB
+
+
+def test_bot_command_and_params():
+    message = parse_message(':foo!foo@foo PRIVMSG #bar :!sr  never gonna give you up ')
+    assert message.bot_command == 'sr'
+    assert message.bot_command_params == 'never gonna give you up'
+    assert parse_message(':foo!foo@foo PRIVMSG #bar :!song').bot_command_params is None
+
+
+def test_message_without_tags_or_source():
+    message = parse_message('PING :tmi.twitch.tv')
+    assert message.command == 'PING'
+    assert message.parameters == 'tmi.twitch.tv'
+    assert message.source is None
+    assert message.nick is None
+    assert message.channel is None
+    assert message.tags.get('badges') is None
+
+
+def test_parameters_keep_colons():
+    message = parse_message(':foo!foo@foo PRIVMSG #bar :see https://example.com :)')
+    assert message.parameters == 'see https://example.com :)'
+
+
+def test_command_only():
+    message = parse_message(':tmi.twitch.tv RECONNECT')
+    assert message.command == 'RECONNECT'
+    assert message.parameters is None
+
+
+def test_invalid_lines():
+    assert parse_message('') is None
+    assert parse_message('\r\n') is None
+    assert parse_message('@badges=') is None
+    assert parse_message(':tmi.twitch.tv') is None
+
+
+def test_tags_are_decoded_lazily():
+    tags = IrcTags(r'badges=;mod=1;first-msg=0;system-msg=hello\sworld\:\\;display-name=Foo')
+    assert tags.decoded == {}
+    assert tags.get('mod') is True
+    assert tags.get('first-msg') is False
+    assert tags.get('badges') is None
+    assert tags.get('system-msg') == 'hello world;\\'
+    assert tags['display-name'] == 'Foo'
+    assert set(tags.decoded) == {'mod', 'first-msg', 'badges', 'system-msg', 'display-name'}
+
+
+def test_tag_lookup_does_not_match_suffixes():
+    tags = IrcTags('user-id=1;id=2')
+    assert tags.get('id') == '2'
+    assert 'room-id' not in tags
+    assert tags.get('room-id', 'missing') == 'missing'
+
+
+def test_mod_tag_grants_mod_permission():
+    message = parse_message('@badges=;mod=1 :foo!foo@foo PRIVMSG #bar :hi')
+    assert message.permissions == BADGE_MOD
+
+
+def test_repr_shows_the_message():
+    message = parse_message(':tmi.twitch.tv NOTICE #channel :Login unsuccessful')
+    assert repr(message) == "IrcMessage(NOTICE #channel: 'Login unsuccessful')"
@@ -0,0 +1,96 @@
+from asyncio import run
+
+import rate_limit
+from rate_limit import SlidingWindowLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.slept.append(delay)
+        self.now += delay
+
+
+def fake_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limit, 'sleep', clock.sleep)
+    return clock
+
+
+def acquire(limiter, times):
+    async def main():
+        for _ in range(times):
+            await limiter.acquire()
+    run(main())
+
+
+def test_limiter_lets_the_limit_through_at_once(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = SlidingWindowLimiter(3, 10)
+    acquire(limiter, 3)
+    assert clock.slept == []
+    assert limiter.stats()['used'] == 3
+
+
+def test_limiter_waits_for_the_oldest_to_leave_the_window(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = SlidingWindowLimiter(2, 10)
+    acquire(limiter, 1)
+    clock.now += 4
+    acquire(limiter, 2)
+    # The first acquisition leaves the window 10 seconds after it was made
+    assert clock.slept == [6]
+    assert limiter.stats()['waited_s'] == 6
+
+
+def test_limiter_forgets_old_acquisitions(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = SlidingWindowLimiter(2, 10)
+    acquire(limiter, 2)
+    clock.now += 10
+    acquire(limiter, 2)
+    assert clock.slept == []
+
+
+def test_bucket_spends_its_burst_then_waits_for_refill(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(2, 0.5)
+    acquire(bucket, 3)
+    assert clock.slept == [2]
+    assert bucket.stats()['tokens'] == 0
+
+
+def test_bucket_never_holds_more_than_its_capacity(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(2, 1)
+    clock.now += 60
+    assert bucket.stats()['tokens'] == 2
+
+
+def test_bucket_for_window_stays_within_the_limit(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket.for_window(20, 30)
+    sent = []
+
+    async def main():
+        while clock.now < 1000 + 90:
+            await bucket.acquire()
+            sent.append(clock.now)
+    run(main())
+    for start in sent:
+        assert sum(1 for t in sent if start <= t < start + 30) <= 20
+
+
+def test_bucket_for_window_with_a_limit_of_one(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket.for_window(1, 30)
+    assert bucket.rate > 0
+    acquire(bucket, 3)
+    assert clock.slept == [30, 30]
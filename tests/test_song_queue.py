@@ -0,0 +1,83 @@
+import json
+from types import SimpleNamespace
+
+import song_queue
+from song_queue import DUPLICATE, USER_LIMIT, SongQueue
+
+
+def make_manager(max_per_user=3):
+    return SimpleNamespace(configuration={'queue': {'max_per_user': max_per_user, 'max_batch': 50}},
+                           print=SimpleNamespace(print_to_logs=lambda *_: None, BRIGHT_PURPLE=''))
+
+
+def track(track_id):
+    return {'id': track_id, 'name': f'Song {track_id}', 'artists': [{'name': 'Artist'}], 'duration_ms': 1000}
+
+
+def add(queue, track_id, requester='viewer'):
+    assert queue.check(track_id, requester) is None
+    return queue.add(track(track_id), requester, requester)
+
+
+def test_journal_replay(tmp_path):
+    journal = str(tmp_path / 'queue.journal')
+    queue = SongQueue(make_manager(max_per_user=0), journal)
+    for track_id in 'abcd':
+        add(queue, track_id)
+    queue.remove('b')
+    queue.advance('c')
+    queue.close()
+
+    restored = SongQueue(make_manager(), journal)
+    assert [entry['id'] for entry in restored.snapshot()] == ['d']
+    assert restored.by_requester == {'viewer': 1}
+    restored.close()
+
+
+def test_replay_skips_a_half_written_line(tmp_path):
+    journal = tmp_path / 'queue.journal'
+    journal.write_text(json.dumps({'op': 'add', 'data': {**track('a'), 'requester': 'viewer'}}) + '\n'
+                       + '{"op": "add", "da', encoding='utf-8')
+    queue = SongQueue(make_manager(), str(journal))
+    assert 'a' in queue
+    assert len(queue) == 1
+    queue.close()
+
+
+def test_compaction_keeps_only_queued_songs(tmp_path, monkeypatch):
+    monkeypatch.setattr(song_queue, 'MIN_COMPACTION_SIZE', 4)
+    journal = tmp_path / 'queue.journal'
+    queue = SongQueue(make_manager(max_per_user=0), str(journal))
+    for idx in range(10):
+        add(queue, str(idx))
+        queue.remove(str(idx))
+    add(queue, 'kept')
+    queue.close()
+    lines = journal.read_text(encoding='utf-8').splitlines()
+    assert len(lines) < 10
+    assert [entry['id'] for entry in SongQueue(make_manager(), str(journal)).snapshot()] == ['kept']
+
+
+def test_duplicates_and_user_limit(tmp_path):
+    queue = SongQueue(make_manager(max_per_user=2), str(tmp_path / 'queue.journal'))
+    add(queue, 'a')
+    add(queue, 'b')
+    assert queue.check('a', 'other') == DUPLICATE
+    assert queue.check('c', 'viewer') == USER_LIMIT
+    assert queue.check('c', 'viewer', bypass_limits=True) is None
+    queue.close()
+
+
+def test_check_reserves_the_track_until_added_or_released(tmp_path):
+    queue = SongQueue(make_manager(max_per_user=1), str(tmp_path / 'queue.journal'))
+    assert queue.check('a', 'viewer') is None
+    # Still waiting for Spotify: the same track and a second song of the same viewer are refused
+    assert queue.check('a', 'other') == DUPLICATE
+    assert queue.check('b', 'viewer') == USER_LIMIT
+    queue.release('a')
+    assert queue.check('a', 'other') is None
+    queue.add(track('a'), 'other', 'other')
+    queue.release('a')
+    assert queue.pending == {} and not queue.pending_by_requester
+    assert queue.advance('a')[0]['id'] == 'a'
+    queue.close()